@@ -1,69 +1,179 @@
+import heapq
 import logging
-import sys
 from collections import defaultdict
+from itertools import count
 
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
 
 from exchange_items import island_position
 
-import networkx as nx
-import networkx.algorithms.approximation as nx_app
-import matplotlib.pyplot as plt
+from utility import Save, get_world_snapshot, world_snapshot_version
 
-from utility import Save
+
+# sklearn, matplotlib, networkx 載入很慢, 只在分群或繪圖時才載入
+def get_kmeans():
+    from sklearn.cluster import KMeans
+    from sklearn.preprocessing import StandardScaler
+    return KMeans, StandardScaler
+
+
+def get_pyplot():
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def get_networkx():
+    import networkx as nx
+    return nx
+
+
+def all_pairs_dijkstra_path(graph_map):
+    # 與 networkx.all_pairs_dijkstra_path 相同的走訪順序, 距離相同時選到的路徑也相同
+    for source in graph_map:
+        dist = {}
+        seen = {source: 0}
+        paths = {source: [source]}
+        counter = count()
+        fringe = [(0, next(counter), source)]
+        while fringe:
+            d, _, v = heapq.heappop(fringe)
+            if v in dist:
+                continue
+            dist[v] = d
+            for u, weight in graph_map[v]:
+                vu_dist = d + weight
+                if u in dist:
+                    continue
+                if u not in seen or vu_dist < seen[u]:
+                    seen[u] = vu_dist
+                    heapq.heappush(fringe, (vu_dist, next(counter), u))
+                    paths[u] = paths[v] + [u]
+        yield source, paths
 
 
 class IslandGraph(Save):
-    def __init__(self, start_island):
+    def __init__(self, start_island, draw=True, snapshot=True, storage=True):
         super().__init__()
         try:
+            self.stats = None
             self.start_island = start_island
             self.island_positions = island_position.copy()
 
-            self.island_nx_graph = nx.Graph()
-            self.group_nx_graph = nx.Graph()
+            self.island_index = {}
+            self.island_distance_matrix = np.zeros((0, 0))
+            self.group_index = {}
+            self.group_distance_matrix = np.zeros((0, 0))
 
             self.graph = {}
+            self.build_distance_matrix(False)
             self.create_graph_from_positions(False, 7)
 
-            if not self.__dict__.get('island_group_map'):
+            # storage=False 時不讀也不寫 storage, 給 build_world_snapshot.py 由來源表重新分群
+            if not storage or not self.load('island_group_map'):
                 self.island_group_map = {}
 
-            if not self.__dict__.get('group_island_map'):
+            if not storage or not self.load('group_island_map'):
                 self.group_island_map = {}
 
-            if not self.__dict__.get('group_position'):
-                self.cluster_islands(draw=True)
-
-                self.group_position = self.calculate_group_centroids()
+            if not storage or not self.load('group_position'):
+                # 快照裡有預先分好的群組, 第一次啟動不用載入 sklearn 分群; 之後由 storage 讀取, 不開快照
+                world = get_world_snapshot() if snapshot else None
+                if world is not None:
+                    self.load_group_map(world)
+                else:
+                    self.cluster_islands(draw=draw)
 
                 self.group_position = self.calculate_group_centroids()
 
             self.group_graph = {}
+            self.group_paths = None
+            self.group_passed_islands = None
+            self.build_distance_matrix(True)
             self.create_graph_from_positions(True, 25)
+            self.build_passed_island_cache()
+
+            self.held_karp_limit = 12
+            self.tour_cache = {}
 
-            self.save()
+            if storage:
+                self.save()
         except Exception as e:
             logging.exception(e)
 
+    def load_group_map(self, world):
+        groups = world['groups'].tolist()
+        self.island_group_map = {
+            island: groups[group]
+            for island, group in zip(self.island_positions.keys(), world['island_groups'].tolist()) if group >= 0
+        }
+        self.group_island_map = {group: [] for group in groups}
+        for island, group in self.island_group_map.items():
+            self.group_island_map[group].append(island)
+
+    def to_world_arrays(self):
+        # 只存分群結果, 距離陣列與群組路徑啟動時計算不比讀檔慢
+        groups = list(self.group_position.keys())
+        return {
+            'version': np.array(world_snapshot_version),
+            'groups': np.array(groups),
+            'island_groups': np.array(
+                [self.group_index.get(self.island_group_map.get(island), -1) for island in self.island_positions],
+                dtype=np.int32),
+        }
+
     def add_island(self, island, x, y):
         self.island_positions[island] = (x, y)
         if island not in self.graph:
             self.graph[island] = []
+        self.build_distance_matrix(False)
+        self.clear_passed_island_cache()
+        self.tour_cache = {}
+
+    def build_distance_matrix(self, is_group):
+        position_map = self.group_position if is_group else self.island_positions
+
+        index = {name: i for i, name in enumerate(position_map.keys())}
+        positions = np.array(list(position_map.values()), dtype=float).reshape(-1, 2)
+        delta = positions[:, np.newaxis, :] - positions[np.newaxis, :, :]
+        matrix = np.sqrt((delta ** 2).sum(axis=-1))
+
+        if is_group:
+            self.group_index, self.group_distance_matrix = index, matrix
+        else:
+            self.island_index, self.island_distance_matrix = index, matrix
+
+    def get_distance_group(self, is_group):
+        return self.group_index if is_group else self.island_index, \
+            self.group_distance_matrix if is_group else self.island_distance_matrix
+
+    def get_index(self, island, is_group=False):
+        index, _ = self.get_distance_group(is_group)
+        return index[island]
+
+    def get_indices(self, islands, is_group=False):
+        index, _ = self.get_distance_group(is_group)
+        return np.fromiter((index[island] for island in islands), dtype=np.intp)
+
+    def calculate_distance_by_index(self, index1, index2, is_group=False):
+        _, matrix = self.get_distance_group(is_group)
+        return matrix[index1, index2]
 
     def calculate_distance(self, island1, island2, is_group=False):
-        _, position_map, _ = self.get_variable_group(is_group)
-        x1, y1 = position_map[island1]
-        x2, y2 = position_map[island2]
-        return np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+        index, matrix = self.get_distance_group(is_group)
+        return matrix[index[island1], index[island2]]
+
+    def calculate_distances_from(self, island, islands=None, is_group=False):
+        index, matrix = self.get_distance_group(is_group)
+        row = matrix[index[island]]
+        if islands is None:
+            return row
+        return row[self.get_indices(islands, is_group)]
 
     def calculate_distance_with_start_island(self, island):
         return self.calculate_distance(island, self.start_island)
 
     def add_edge(self, u, v, weight, is_group):
-        graph_map, _, _ = self.get_variable_group(is_group)
+        graph_map, _ = self.get_variable_group(is_group)
 
         if u not in graph_map:
             graph_map[u] = []
@@ -74,7 +184,13 @@ class IslandGraph(Save):
         graph_map[v].append((u, float(weight)))
 
     def draw_graph(self, is_group):
-        graph_map, position_map, nx_graph = self.get_variable_group(is_group)
+        nx = get_networkx()
+        plt = get_pyplot()
+
+        graph_map, position_map = self.get_variable_group(is_group)
+        nx_graph = nx.Graph()
+        nx_graph.add_weighted_edges_from(
+            (island, neighbor, weight) for island, neighbors in graph_map.items() for neighbor, weight in neighbors)
         plt.figure()
 
         plt.rcParams['font.sans-serif'] = ['Microsoft YaHei']
@@ -86,6 +202,7 @@ class IslandGraph(Save):
 
     @staticmethod
     def draw_clustering(labels, coordinates, islands):
+        plt = get_pyplot()
         plt.figure()
         colors = ['r', 'g', 'b', 'c', 'm', 'y', 'k', 'orange', 'purple', 'brown', 'pink', 'gray', 'olive', 'indigo']
         for i, label in enumerate(labels):
@@ -127,29 +244,31 @@ class IslandGraph(Save):
 
     def get_variable_group(self, is_group):
         return self.group_graph if is_group else self.graph, \
-            self.group_position if is_group else self.island_positions, \
-            self.group_nx_graph if is_group else self.island_nx_graph
+            self.group_position if is_group else self.island_positions
 
     def create_graph_from_positions(self, is_group, max_distance=9):
-        graph_map, position_map, nx_graph = self.get_variable_group(is_group)
+        graph_map, position_map = self.get_variable_group(is_group)
+        _, matrix = self.get_distance_group(is_group)
 
         islands = list(position_map.keys())
-        for i, island1 in enumerate(islands):
-            for j, island2 in enumerate(islands):
-                if i == j:
-                    continue
-                distance = self.calculate_distance(island1, island2, is_group)
-                if distance <= max_distance:
-                    self.add_edge(island1, island2, distance, is_group)
-                    nx_graph.add_edge(island1, island2, weight=distance)
+        rows, cols = np.nonzero(np.triu(matrix <= max_distance, k=1))
+        edges = [
+            (islands[i], islands[j], distance)
+            for i, j, distance in zip(rows.tolist(), cols.tolist(), matrix[rows, cols].tolist())
+        ]
+
+        for island1, island2, distance in edges:
+            self.add_edge(island1, island2, distance, is_group)
 
     def cluster_islands(self, num_clusters=8, draw=False):
         islands = list(self.island_positions.keys())
         coordinates = np.array(list(self.island_positions.values()))
+        KMeans, StandardScaler = get_kmeans()
         scaler = StandardScaler()
         scaled_coordinates = scaler.fit_transform(coordinates)
 
-        k_means = KMeans(n_clusters=num_clusters).fit(scaled_coordinates)
+        # 固定亂數種子, 同樣的島嶼表每次分出相同的群組
+        k_means = KMeans(n_clusters=num_clusters, n_init=10, random_state=0).fit(scaled_coordinates)
         labels = k_means.labels_
 
         if draw:
@@ -170,6 +289,7 @@ class IslandGraph(Save):
             group[group_name].append(islands[i])
             self.island_group_map[islands[i]] = group_name
         self.group_island_map = group
+        self.clear_passed_island_cache()
 
     def calculate_group_centroids(self):
         group_centroids = {}
@@ -188,52 +308,83 @@ class IslandGraph(Save):
                 nearby.append(neighbor)
         return nearby
 
-    def find_passed_group(self, start, end):
-        start_group = self.island_group_map[start]
-        end_group = self.island_group_map[end]
+    def clear_passed_island_cache(self):
+        self.group_paths = None
+        self.group_passed_islands = None
+
+    def build_passed_island_cache(self):
+        graph_map, _ = self.get_variable_group(True)
+
+        self.group_paths = {}
+        self.group_passed_islands = {}
+        for start_group, paths in all_pairs_dijkstra_path(graph_map):
+            for end_group, path in paths.items():
+                pass_islands = []
+                for group in path:
+                    pass_islands.extend(self.group_island_map[group])
 
-        graph_map, position_map, nx_graph = self.get_variable_group(True)
-        return nx.dijkstra_path(nx_graph, start_group, end_group)
+                self.group_paths[(start_group, end_group)] = tuple(path)
+                self.group_passed_islands[(start_group, end_group)] = (tuple(pass_islands), frozenset(pass_islands))
+
+    def get_passed_island_cache(self, start, end):
+        if self.stats is not None:
+            self.stats.count('find_passed_islands')
+
+        if self.group_passed_islands is None:
+            self.build_passed_island_cache()
+
+        key = (self.island_group_map[start], self.island_group_map[end])
+        if key not in self.group_paths:
+            raise get_networkx().NetworkXNoPath(f'No path between {key[0]} and {key[1]}.')
+        return key
+
+    def find_passed_group(self, start, end):
+        key = self.get_passed_island_cache(start, end)
+        return list(self.group_paths[key])
 
     def find_passed_islands(self, start, end):
-        pass_group = self.find_passed_group(start, end)
-        if not pass_group:
+        key = self.get_passed_island_cache(start, end)
+        pass_islands, _ = self.group_passed_islands[key]
+        if not pass_islands:
             return []
 
-        pass_islands = []
-        for group in pass_group:
-            pass_islands.extend(self.group_island_map[group])
+        pass_islands = list(pass_islands)
         pass_islands.remove(end)
         return pass_islands
 
+    def find_passed_island_set(self, start, end):
+        key = self.get_passed_island_cache(start, end)
+        _, pass_island_set = self.group_passed_islands[key]
+        return pass_island_set
+
     def is_nearby(self, island, neighbor, max_distance=6):
         return self.calculate_distance(island, neighbor) <= max_distance
 
+    def is_any_nearby(self, island, neighbors, max_distance=6):
+        return bool((self.calculate_distances_from(island, neighbors) <= max_distance).any())
+
+    def find_farthest_island(self, islands):
+        islands = list(islands)
+        if not islands:
+            return self.start_island
+        distances = self.calculate_distances_from(self.start_island, islands)
+        return islands[int(distances.argmax())]
+
     def is_passed_by(self, current_island, visited_islands):
-        max_distance = -float('inf')
-        farthest_island = self.start_island
-        for visited_island in visited_islands:
-            dist = self.calculate_distance(self.start_island, visited_island)
-            if max_distance < dist:
-                max_distance = dist
-                farthest_island = visited_island
-        passed_islands = self.find_passed_islands(self.start_island, farthest_island)
-        if current_island in passed_islands:
+        farthest_island = self.find_farthest_island(visited_islands)
+        passed_islands = self.find_passed_island_set(self.start_island, farthest_island)
+        if current_island != farthest_island and current_island in passed_islands:
             return True
 
-        passed_islands = self.find_passed_islands(self.start_island, current_island)
-        for visited_island in visited_islands:
-            if visited_island not in passed_islands:
-                return False
-        return True
+        passed_islands = self.find_passed_island_set(self.start_island, current_island)
+        return passed_islands.issuperset(visited_islands) and current_island not in visited_islands
 
     def is_island_valid(self, current_island, visited_islands):
         if not visited_islands:
             return True
 
-        for visited_island in visited_islands:
-            if self.is_nearby(current_island, visited_island):
-                return True
+        if self.is_any_nearby(current_island, visited_islands):
+            return True
 
         return self.is_passed_by(current_island, visited_islands)
 
@@ -246,10 +397,10 @@ class IslandGraph(Save):
         )
 
     def find_best_path(self, islands: list):
-        if len(islands) <= 1:
-            return islands
+        if self.stats is not None:
+            self.stats.count('find_best_path')
 
-        if sys.version_info.major < 3 or sys.version_info.minor <= 6:
+        if len(islands) <= 1:
             return islands
 
         exclude_start_island = False
@@ -257,22 +408,92 @@ class IslandGraph(Save):
             islands.append(self.start_island)
             exclude_start_island = True
 
-        nx_graph = nx.Graph()
-        for island in islands:
-            for neighbor in islands:
-                if island == neighbor:
-                    continue
-
-                nx_graph.add_edge(island, neighbor, weight=self.calculate_distance(island, neighbor))
-
-        shortest_path = nx_app.traveling_salesman_problem(nx_graph, cycle=True, method=nx_app.christofides)
-        shortest_path = list(dict.fromkeys(shortest_path).keys())
-
-        if shortest_path[0] != self.start_island or shortest_path[-1] != self.start_island:
-            start_index = shortest_path.index(self.start_island)
-            shortest_path = shortest_path[start_index:] + shortest_path[:start_index]
+        shortest_path = list(self.find_shortest_tour(islands))
 
         if exclude_start_island:
             shortest_path.remove(self.start_island)
 
         return shortest_path
+
+    def find_shortest_tour(self, islands):
+        key = frozenset(islands)
+        tour = self.tour_cache.get(key)
+        if tour is not None:
+            return tour
+
+        others = [island for island in dict.fromkeys(islands) if island != self.start_island]
+        nodes = [self.start_island] + others
+        indices = self.get_indices(nodes)
+        distances = self.island_distance_matrix[np.ix_(indices, indices)].tolist()
+
+        if len(others) <= self.held_karp_limit:
+            order = self.held_karp(distances)
+        else:
+            order = self.two_opt(distances)
+
+        tour = tuple(nodes[i] for i in order)
+        self.tour_cache[key] = tour
+        return tour
+
+    @staticmethod
+    def held_karp(distances):
+        # 以起點 0 出發並回到起點, dp[mask][j] 為走過 mask 且停在 j 的最短距離
+        n = len(distances)
+        if n <= 2:
+            return list(range(n))
+
+        size = 1 << (n - 1)
+        dp = [[float('inf')] * n for _ in range(size)]
+        parent = [[0] * n for _ in range(size)]
+        for j in range(1, n):
+            dp[1 << (j - 1)][j] = distances[0][j]
+
+        for mask in range(1, size):
+            dp_mask = dp[mask]
+            for j in range(1, n):
+                cost = dp_mask[j]
+                if cost == float('inf'):
+                    continue
+                row = distances[j]
+                for k in range(1, n):
+                    bit = 1 << (k - 1)
+                    if mask & bit:
+                        continue
+                    new_cost = cost + row[k]
+                    if new_cost < dp[mask | bit][k]:
+                        dp[mask | bit][k] = new_cost
+                        parent[mask | bit][k] = j
+
+        full = size - 1
+        last = min(range(1, n), key=lambda j: dp[full][j] + distances[j][0])
+
+        order = []
+        mask = full
+        while last:
+            order.append(last)
+            mask, last = mask ^ (1 << (last - 1)), parent[mask][last]
+        order.append(0)
+        return order[::-1]
+
+    @staticmethod
+    def two_opt(distances):
+        n = len(distances)
+        order = [0]
+        remain = set(range(1, n))
+        while remain:
+            last = order[-1]
+            nearest = min(remain, key=lambda j: distances[last][j])
+            order.append(nearest)
+            remain.remove(nearest)
+
+        improved = True
+        while improved:
+            improved = False
+            for i in range(1, n - 1):
+                for j in range(i + 1, n):
+                    a, b = order[i - 1], order[i]
+                    c, d = order[j], order[(j + 1) % n]
+                    if distances[a][c] + distances[b][d] < distances[a][b] + distances[c][d] - 1e-9:
+                        order[i:j + 1] = order[i:j + 1][::-1]
+                        improved = True
+        return order
@@ -0,0 +1,435 @@
+import time
+from concurrent.futures import wait
+from contextlib import nullcontext
+
+import numpy as np
+
+from utility import SearchStats, ExchangeTable
+
+route_worker_context = {}
+no_span = nullcontext()
+
+
+def init_route_worker(island_graph, current_run, run_contexts):
+    route_worker_context['island_graph'] = island_graph
+    route_worker_context['current_run'] = current_run
+    route_worker_context['run_contexts'] = run_contexts
+    route_worker_context['run'] = None
+
+
+class RunCancelEvent:
+    # 子行程看不到主行程的 threading.Event, 改比對共享記憶體裡的執行編號, 編號變了表示這次排程被取消或被取代
+    def __init__(self, current_run, run_id):
+        self.current_run = current_run
+        self.run_id = run_id
+
+    def is_set(self):
+        return self.current_run.value != self.run_id
+
+
+def get_run_context(run_id):
+    # 同一次求解的交換與設定, 每個 worker 只向 manager 取一次
+    run = route_worker_context['run']
+    if run is None or run[0] != run_id:
+        run = (run_id, route_worker_context['run_contexts'][run_id], time.monotonic())
+        route_worker_context['run'] = run
+    return run
+
+
+def solve_route_subproblem(task):
+    run_id, mask, visited, current_weight, current_swap_cost = task
+
+    cancel_event = RunCancelEvent(route_worker_context['current_run'], run_id)
+    try:
+        if cancel_event.is_set():
+            raise KeyError(run_id)
+        _, context, started = get_run_context(run_id)
+    except KeyError:
+        # 這次求解已經被取消, 輸入也已經刪除
+        return 0, (), current_swap_cost, True, None
+
+    exchanges, trade_limit, ship_load_capacity, min_swap_cost, branch_and_bound, time_budget, collect_stats = context
+    stats = SearchStats() if collect_stats else None
+    island_graph = route_worker_context['island_graph']
+    island_graph.stats = stats
+
+    solver = RouteSolver(
+        island_graph, None, exchanges,
+        ship_load_capacity, min_swap_cost, branch_and_bound,
+        None if time_budget is None else started + time_budget,
+        stats,
+        cancel_event=cancel_event,
+        trade_limit=trade_limit,
+    )
+    gain, path, remain_swap_cost = solver.solve_from(mask, visited, current_weight, current_swap_cost)
+    return gain, path, remain_swap_cost, solver.timed_out, None if stats is None else dict(stats.counters)
+
+
+class RouteSolver:
+    def __init__(self, island_graph, stock, exchanges: dict, ship_load_capacity, min_swap_cost,
+                 branch_and_bound=False, deadline=None, stats=None, tracer=None, cancel_event=None, trade_limit=None):
+        self.island_graph = island_graph
+        self.stock = stock
+        self.ship_load_capacity = ship_load_capacity
+        self.min_swap_cost = min_swap_cost
+        self.branch_and_bound = branch_and_bound
+        self.deadline = deadline
+        self.cancel_event = cancel_event
+        self.timed_out = False
+        self.stats = stats
+        self.tracer = tracer
+        self.root_depth = 0
+
+        self.exchanges = list(exchanges.values())
+        self.table = ExchangeTable(self.exchanges)
+        if trade_limit is None:
+            trade_limit = self.table.count_trade_limit(self.table.count_available_stock(stock))
+        self.trade_limit = trade_limit
+        self.full_mask = (1 << len(self.exchanges)) - 1
+        self.memo = {}
+        self.bound_memo = {}
+        self.valid_memo = {}
+
+        # 搜尋狀態只用一份: 路徑堆疊存 exchange 的 index, 交換次數存在固定長度的陣列
+        self.path = []
+        self.trades = [0] * len(self.exchanges)
+        self.visited = set()
+        self.incumbent = None
+        self.incumbent_value = -float('inf')
+        self.bound_candidates = self.get_bound_candidates()
+
+    def get_mask(self, visited):
+        mask = 0
+        for i, exchange in enumerate(self.exchanges):
+            if exchange.island in visited:
+                mask |= 1 << i
+        return mask
+
+    def get_valid_candidates(self, mask):
+        result = self.valid_memo.get(mask)
+        if result is not None:
+            return result
+
+        candidates = []
+        indices = []
+        for i, exchange in enumerate(self.exchanges):
+            if mask & (1 << i):
+                continue
+
+            if self.stats is not None:
+                self.stats.count('is_island_valid')
+            if not self.island_graph.is_island_valid(exchange.island, self.visited):
+                continue
+            candidates.append((i, exchange))
+            indices.append(i)
+
+        result = (candidates, np.array(indices, dtype=int))
+        self.valid_memo[mask] = result
+        return result
+
+    def get_bound_candidates(self):
+        # (bit, priority, 單次交換的最小載重, swap_cost), 依 priority 由大到小排序
+        candidates = []
+        for i, exchange in enumerate(self.exchanges):
+            if self.trade_limit[i] <= 0 or exchange.ratio == 0:
+                continue
+            candidates.append((1 << i, exchange.priority, exchange.ratio * exchange.weight, exchange.swap_cost))
+        candidates.sort(key=lambda x: -x[1])
+        return candidates
+
+    def get_upper_bound(self, mask, current_weight, current_swap_cost):
+        if current_weight > self.ship_load_capacity - 100 or current_swap_cost <= self.min_swap_cost:
+            return 0
+
+        load_capacity = self.ship_load_capacity - current_weight
+        priorities, loads, swap_costs = [], [], []
+        for bit, priority, load, swap_cost in self.bound_candidates:
+            if mask & bit or load > load_capacity or swap_cost > current_swap_cost:
+                continue
+            priorities.append(priority)
+            loads.append(load)
+            swap_costs.append(swap_cost)
+
+        # 剩餘載重與換購成本最多還能容納幾個島
+        max_count = min(
+            self.count_fit(loads, load_capacity),
+            self.count_fit(swap_costs, current_swap_cost),
+        )
+        return sum(priority for priority in priorities[:max_count] if priority > 0)
+
+    @staticmethod
+    def count_fit(costs, capacity):
+        count = 0
+        for cost in sorted(costs):
+            capacity -= cost
+            if capacity < 0:
+                break
+            count += 1
+        return count
+
+    def solve(self, state, visited, island_trades):
+        _, current_weight, current_swap_cost, current_priority = state
+
+        gain, path, remain_swap_cost = self.solve_from(
+            self.get_mask(visited), frozenset(visited), current_weight, current_swap_cost)
+        return self.build_result(state, visited, island_trades, gain, path, remain_swap_cost)
+
+    @staticmethod
+    def build_result(state, visited, island_trades, gain, path, remain_swap_cost):
+        island_trades = island_trades.copy()
+        island_trades.update(path)
+        return state[3] + gain, visited | {island for island, _ in path}, island_trades, remain_swap_cost
+
+    def solve_from(self, mask, visited, current_weight, current_swap_cost):
+        self.visited = set(visited)
+        self.root_depth = len(visited)
+        if self.is_interruptible():
+            self.search_bound(mask, current_weight, current_swap_cost, 0)
+            return self.incumbent
+
+        value, remain_swap_cost, link = self.search(mask, current_weight, current_swap_cost)
+        return value, self.build_path(link), remain_swap_cost
+
+    def build_path(self, link):
+        # 只在需要完整路線時, 沿著 memo 的 (index, trades, child_key) 串回路徑
+        path = []
+        while link is not None:
+            index, trades, key = link
+            path.append((self.exchanges[index].island, trades))
+            link = self.memo[key][2]
+        return tuple(path)
+
+    def solve_parallel(self, state, visited, island_trades, executor, run_contexts, run_id):
+        # 以第一個選擇的島切分子問題, 交給 process pool 平行求解
+        _, current_weight, current_swap_cost, _ = state
+        mask = self.get_mask(visited)
+        self.visited = set(visited)
+
+        children = []
+        if not self.is_terminal(mask, current_weight, current_swap_cost):
+            children = self.get_children(mask, current_weight, current_swap_cost)
+        if len(children) <= 1:
+            return self.solve(state, visited, island_trades)
+
+        if self.is_interruptible():
+            children.sort(key=lambda x: -x[1].priority)
+
+        # pool 是共用的, 這次的交換與可交換次數上限放在 manager, 子問題只帶 run_id 與搜尋狀態
+        time_budget = None if self.deadline is None else max(self.deadline - time.monotonic(), 0)
+        run_contexts[run_id] = (
+            {exchange.island: exchange for exchange in self.exchanges}, self.trade_limit,
+            self.ship_load_capacity, self.min_swap_cost, self.branch_and_bound, time_budget, self.stats is not None,
+        )
+        visited = frozenset(visited)
+
+        futures = [
+            executor.submit(solve_route_subproblem, (
+                run_id, mask | (1 << index), visited | {exchange.island}, new_weight, new_swap_cost,
+            ))
+            for index, exchange, _, new_weight, new_swap_cost in children
+        ]
+
+        # 輪詢等待, 取消時不等還在跑的子問題, 只用已完成的結果
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=0.05)
+            if self.is_cancelled():
+                self.timed_out = True
+                for future in pending:
+                    future.cancel()
+                break
+
+        max_value = -float('inf')
+        best = (0, (), current_swap_cost)
+        for (index, exchange, trades, _, _), future in zip(children, futures):
+            if not future.done() or future.cancelled():
+                continue
+
+            value, path, remain_swap_cost, timed_out, counters = future.result()
+            self.timed_out = self.timed_out or timed_out
+            if self.stats is not None:
+                self.stats.merge(counters)
+
+            value += exchange.priority
+            if value > max_value:
+                max_value = value
+                best = (value, ((exchange.island, trades),) + path, remain_swap_cost)
+
+        return self.build_result(state, set(visited), island_trades, *best)
+
+    def get_children(self, mask, current_weight, current_swap_cost):
+        candidates, indices = self.get_valid_candidates(mask)
+        if not candidates:
+            return []
+
+        # 所有候選島的可交換次數一次算完
+        all_max_allowable_trades = self.table.count_max_allowable_trades(
+            indices,
+            self.ship_load_capacity - current_weight,
+            self.trade_limit,
+            current_swap_cost
+        ).tolist()
+
+        children = []
+        for (index, exchange), max_allowable_trades in zip(candidates, all_max_allowable_trades):
+            if max_allowable_trades <= 0:
+                continue
+
+            new_weight = current_weight + (max_allowable_trades * exchange.ratio * exchange.weight)
+            if new_weight > self.ship_load_capacity:
+                continue
+
+            children.append((
+                index, exchange, max_allowable_trades,
+                new_weight, current_swap_cost - (max_allowable_trades * exchange.swap_cost),
+            ))
+        return children
+
+    def is_terminal(self, mask, current_weight, current_swap_cost):
+        return current_weight > self.ship_load_capacity - 100 or current_swap_cost <= self.min_swap_cost \
+            or mask == self.full_mask
+
+    def trace_span(self, island):
+        if self.tracer is None or len(self.visited) - self.root_depth >= self.tracer.max_depth:
+            return no_span
+        return self.tracer.span('route_dp.expand', island=island, depth=len(self.visited) - self.root_depth)
+
+    def search(self, mask, current_weight, current_swap_cost):
+        # 同一組已拜訪島嶼在相同載重與換購成本下的結果相同, 與拜訪順序無關
+        # 結果為 (value, remain_swap_cost, link), link 指向最佳子節點的 memo key
+        key = (mask, current_weight, current_swap_cost)
+        result = self.memo.get(key)
+        if result is not None:
+            if self.stats is not None:
+                self.stats.count('memo_hits')
+            return result
+
+        result = (0, current_swap_cost, None)
+        if self.is_terminal(mask, current_weight, current_swap_cost):
+            self.memo[key] = result
+            return result
+
+        if self.stats is not None:
+            self.stats.count('nodes_expanded')
+
+        max_value = -float('inf')
+        for index, exchange, trades, new_weight, new_swap_cost in self.get_children(
+                mask, current_weight, current_swap_cost):
+            child_mask = mask | (1 << index)
+            with self.trace_span(exchange.island):
+                self.visited.add(exchange.island)
+                value, remain_swap_cost, _ = self.search(child_mask, new_weight, new_swap_cost)
+                self.visited.discard(exchange.island)
+            value += exchange.priority
+
+            if value > max_value:
+                max_value = value
+                result = (value, remain_swap_cost, (index, trades, (child_mask, new_weight, new_swap_cost)))
+
+        self.memo[key] = result
+        return result
+
+    def update_incumbent(self, current_priority, result):
+        value, remain_swap_cost, link = result
+        if current_priority + value > self.incumbent_value:
+            self.incumbent_value = current_priority + value
+            path = tuple((self.exchanges[index].island, self.trades[index]) for index in self.path)
+            self.incumbent = (current_priority + value, path + self.build_path(link), remain_swap_cost)
+
+    def is_interruptible(self):
+        return self.branch_and_bound or self.deadline is not None or self.cancel_event is not None
+
+    def is_cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def is_expired(self):
+        # 至少要先找到一條完整路線, 時間到了或被取消才停止展開
+        if self.incumbent is None:
+            return False
+        if not self.timed_out and (
+                self.is_cancelled() or self.deadline is not None and time.monotonic() >= self.deadline):
+            self.timed_out = True
+        return self.timed_out
+
+    def search_bound(self, mask, current_weight, current_swap_cost, current_priority):
+        # 回傳 (result, exact), 有被剪枝的子樹結果不完整, 不能寫入 memo
+        # 剪枝後的結果連同當時的門檻 (incumbent - current_priority) 存進 bound_memo:
+        # 真正的最佳值不超過 max(result, threshold), 門檻沒有變低前都可以直接重用
+        key = (mask, current_weight, current_swap_cost)
+        result = self.memo.get(key)
+        if result is not None:
+            if self.stats is not None:
+                self.stats.count('memo_hits')
+            self.update_incumbent(current_priority, result)
+            return result, True
+
+        bound = self.bound_memo.get(key)
+        if bound is not None and bound[1] <= self.incumbent_value - current_priority:
+            if self.stats is not None:
+                self.stats.count('bound_hits')
+            return bound[0], False
+
+        children = []
+        if not self.is_terminal(mask, current_weight, current_swap_cost):
+            children = self.get_children(mask, current_weight, current_swap_cost)
+
+        if not children:
+            result = (0, current_swap_cost, None)
+            self.memo[key] = result
+            self.update_incumbent(current_priority, result)
+            return result, True
+
+        if self.stats is not None:
+            self.stats.count('nodes_expanded')
+
+        children.sort(key=lambda x: -x[1].priority)
+
+        result = None
+        exact = True
+        for index, exchange, trades, new_weight, new_swap_cost in children:
+            if self.is_expired():
+                exact = False
+                break
+
+            child_mask = mask | (1 << index)
+            new_priority = current_priority + exchange.priority
+            upper_bound = self.get_upper_bound(child_mask, new_weight, new_swap_cost)
+            if new_priority + upper_bound <= self.incumbent_value:
+                if self.stats is not None:
+                    self.stats.count('nodes_pruned')
+                exact = False
+                continue
+
+            self.path.append(index)
+            self.trades[index] = trades
+            with self.trace_span(exchange.island):
+                self.visited.add(exchange.island)
+                child_result, child_exact = self.search_bound(child_mask, new_weight, new_swap_cost, new_priority)
+                self.visited.discard(exchange.island)
+            self.path.pop()
+
+            exact = exact and child_exact
+            if child_result is None:
+                continue
+
+            value = child_result[0] + exchange.priority
+            if result is None or value > result[0]:
+                result = (value, child_result[1], (index, trades, (child_mask, new_weight, new_swap_cost)))
+
+        if exact:
+            self.memo[key] = result
+            return result, True
+
+        # 時間到中斷的子樹沒有上界保證, 不能重用
+        if self.timed_out:
+            return result, False
+
+        threshold = self.incumbent_value - current_priority
+        if result is not None and result[0] > threshold and (result[2] is None or result[2][2] in self.memo):
+            # 被剪掉的子樹都不超過門檻, 比門檻高的結果就是最佳解
+            # 浮點誤差可能讓子節點沒有被判定為精確, 路徑要能從 memo 串回才寫入
+            self.memo[key] = result
+            return result, True
+
+        self.bound_memo[key] = (result, threshold)
+        return result, False
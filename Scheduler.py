@@ -1,12 +1,16 @@
 import logging
-import os
-import re
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
 
 from Island import IslandGraph
+from RouteSolver import RouteSolver, init_route_worker
 from Stock import Stock
-from exchange_items import default_ship_load_capacity, default_swap_cost
-from utility import Save, Exchange, Station_tuple, Route_tuple
+from exchange_items import default_ship_load_capacity, default_swap_cost, default_time_budget, default_workers, \
+    parallel_min_exchanges
+from utility import Save, Exchange, Station_tuple, Route_tuple, SearchStats, Tracer
 
 
 class Scheduler(Save):
@@ -25,20 +29,45 @@ class Scheduler(Save):
         self.start_island = island_graph.start_island
         self.min_swap_cost = None
         self.total_swap_cost = 1000000
+        self.branch_and_bound = True
+        self.deadline = None
+        self.cancel_event = None
+        self.is_optimal = True
+        self.run_workers = 0
+        self.pool = None
+        self.pool_workers = 0
+        self.manager = None
+        self.run_contexts = None
+        self.current_run = None
+        self.run_id = 0
+        self.collect_stats = True
+        self.stats = None
+        self.trace = False
+        self.tracer = None
+        self.trace_file = None
 
         if not self.__dict__.get('default_swap_cost'):
             self.default_swap_cost = default_swap_cost
 
+        if 'time_budget' not in self.__dict__:
+            self.time_budget = default_time_budget
+
+        if 'workers' not in self.__dict__:
+            self.workers = default_workers
+
         self.checked_stations = {}
         self.settings = {}
 
     def read_settings(self):
-        settings = self.__dict__.get('settings')
+        settings = self.load('settings')
         if not settings:
             return
 
         self.ship_load_capacity = settings.get('ship_load_capacity', default_ship_load_capacity)
         self.default_swap_cost = settings.get('default_swap_cost', default_swap_cost)
+        self.time_budget = settings.get('time_budget', default_time_budget)
+        # 舊設定存的 0 是當時的預設值 (不平行), 改用新的預設
+        self.workers = settings.get('workers') or default_workers
 
     def add_trade(self, exchanges: dict):
         self.save_exchanges = {}
@@ -81,30 +110,13 @@ class Scheduler(Save):
             if exchange.level == 'material':
                 exchange.priority += 10
 
-    def count_version(self, filename):
-        version = 1
-        for f in os.listdir(self.folder):
-            f.startswith(filename)
-            match = re.search(r'_v(\d+)', f)
-            if not match:
-                continue
-
-            _version = int(match.group(1))
-            if _version > version:
-                version = _version
-        return version
-
     def save_exchanges_all(self, *args):
         for target_name in args:
             target = self.__dict__.get(target_name)
             if not target:
                 continue
 
-            date = datetime.today().strftime('%Y%m%d')
-            filename = f'{target_name}_{date}_v{{}}'
-            version = self.count_version(filename)
-
-            self.save_json(filename.format(version + 1), target)
+            self.save_record(target_name, target)
 
     def save_exchanges_remain(self):
         exchanges_remain = {}
@@ -130,16 +142,14 @@ class Scheduler(Save):
 
         exchanges_remain['remain_swap_cost'] = remain_swap_cost
 
-        date = datetime.today().strftime('%Y%m%d')
-        filename = f'remain_exchanges_{date}_v{{}}'
-        version = self.count_version(filename)
-
-        self.save_json(filename.format(version + 1), exchanges_remain)
+        self.save_record('remain_exchanges', exchanges_remain)
 
     def save_settings(self):
         self.settings = {
             'ship_load_capacity': self.ship_load_capacity,
             'default_swap_cost': self.default_swap_cost,
+            'time_budget': self.time_budget,
+            'workers': self.workers,
         }
         self.save('settings')
 
@@ -171,159 +181,226 @@ class Scheduler(Save):
             exchange.reset_remain_exchange()
         self.checked_stations = {}
 
-    def schedule_routes(self):
+    def time_phase(self, name):
+        if self.stats is None:
+            return nullcontext()
+        return self.stats.timer(name)
+
+    def trace_span(self, name, **args):
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.span(name, **args)
+
+    def save_trace(self):
+        self.trace_file = f'{self.folder}/trace_{datetime.today().strftime("%Y%m%d_%H%M%S")}.json'
+        self.tracer.save(self.trace_file)
+
+    def schedule_routes(self, time_budget=None, workers=0):
+        return list(self.iter_routes(time_budget, workers))
+
+    def is_cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def iter_routes(self, time_budget=None, workers=0, cancel_event=None):
+        # 每條路線確定後就 yield, 介面可以邊算邊顯示
+        self.tracer = Tracer() if self.trace else None
+        try:
+            with self.trace_span('schedule_routes', exchanges=len(self.exchanges)):
+                yield from self._iter_routes(time_budget, workers, cancel_event)
+        finally:
+            if self.tracer is not None:
+                self.save_trace()
+                self.tracer = None
+
+    def _iter_routes(self, time_budget, workers, cancel_event):
+        self.deadline = None if time_budget is None else time.monotonic() + time_budget
+        self.cancel_event = cancel_event
+        self.is_optimal = True
+        self.stats = SearchStats() if self.collect_stats else None
+        self.island_graph.stats = self.stats
+
         self.stock.restore()
         self.stock.switch_stock(True)
         self.reset_all_exchanges()
 
         remain_swap_cost = self.total_swap_cost
 
-        best_routes = []
         try:
+            # 追蹤紀錄只涵蓋本行程, 要看完整的 route_dp.expand 時一律不平行
+            if self.tracer is None:
+                self.run_workers = workers
+
             # 伊利亞
-            start_island_exchange = self.exchanges.get(self.start_island)
-            if start_island_exchange:
-                available_stock = self.stock.count_available_stock(start_island_exchange)
-                if available_stock > 0:
-                    max_trades = start_island_exchange.count_max_allowable_trades(
-                        100000000,
-                        available_stock,
-                        remain_swap_cost
-                    )
-                    route_exchanges = self.virtual_execute_exchange({self.start_island}, {self.start_island: max_trades})
-                    best_routes.append(Route_tuple(f'{self.start_island}', route_exchanges))
+            route_exchanges = []
+            with self.time_phase(self.start_island):
+                start_island_exchange = self.exchanges.get(self.start_island)
+                if start_island_exchange:
+                    available_stock = self.stock.count_available_stock(start_island_exchange)
+                    if available_stock > 0:
+                        max_trades = start_island_exchange.count_max_allowable_trades(
+                            100000000,
+                            available_stock,
+                            remain_swap_cost
+                        )
+                        route_exchanges = self.virtual_execute_exchange(
+                            {self.start_island}, {self.start_island: max_trades})
+            if route_exchanges:
+                yield Route_tuple(f'{self.start_island}', route_exchanges)
 
             # 伊利亞 - 貝村
-            route_exchanges, remain_swap_cost = self.find_specify_route(self.start_island, '貝村',
-                                                                        remain_swap_cost)
+            with self.time_phase('貝村'):
+                route_exchanges, remain_swap_cost = self.find_specify_route(self.start_island, '貝村',
+                                                                            remain_swap_cost)
             if route_exchanges:
-                best_routes.append(Route_tuple(f'{self.start_island} - 貝村', route_exchanges))
+                yield Route_tuple(f'{self.start_island} - 貝村', route_exchanges)
 
             # 伊利亞 - 澳眼
-            route_exchanges, remain_swap_cost = self.find_specify_route(self.start_island, '澳眼',
-                                                                        remain_swap_cost)
+            with self.time_phase('澳眼'):
+                route_exchanges, remain_swap_cost = self.find_specify_route(self.start_island, '澳眼',
+                                                                            remain_swap_cost)
             if route_exchanges:
-                best_routes.append(Route_tuple(f'{self.start_island} - 澳眼', route_exchanges))
+                yield Route_tuple(f'{self.start_island} - 澳眼', route_exchanges)
 
             first_island = list(self.exchanges.keys())[0]
             routes = self.find_best_routes(0, first_island, remain_swap_cost)
-            best_routes.extend(routes)
+            while True:
+                # 計時不包含呼叫端處理每條路線的時間
+                with self.time_phase('Group'):
+                    route = next(routes, None)
+                if route is None:
+                    break
+                yield route
 
             self.reset_all_exchanges()
         except Exception as e:
             logging.exception(e)
-        return best_routes
-
-    def find_specify_route(self, start_island, end_island, remain_swap_cost):
-        target_islands = self.island_graph.find_passed_islands(start_island, end_island)
-        target_islands.extend(self.island_graph.find_nearby_islands(start_island, 7))
-        target_exchanges = {island: self.exchanges[island] for island in target_islands if
-                            self.exchanges.get(island)}
-        _, route_1, island_trades_1, remain_swap_cost = self.route_dp(
-            (self.island_graph.start_island, 0, remain_swap_cost, 0),
-            set(),
-            {},
-            target_exchanges
-        )
-        return self.virtual_execute_exchange(route_1, island_trades_1), remain_swap_cost
-
-    def find_best_routes(self, index, island, swap_cost):
-        if swap_cost < self.min_swap_cost:
-            return []
-
-        pr, route, island_trades, remain_swap_cost = self.route_dp((
-            island,
-            0,
-            swap_cost,
-            self.exchanges[island].priority,
-        ),
-            set(),
-            {},
-            self.exchanges
+        finally:
+            self.run_workers = 0
+            self.deadline = None
+            self.cancel_event = None
+            self.island_graph.stats = None
+
+    def get_pool(self, workers):
+        # process pool 只建一次, 之後的排程共用, worker 數改變才重建
+        if self.pool is not None and self.pool_workers == workers:
+            return self.pool
+        self.close_pool()
+        if self.current_run is None:
+            self.current_run = multiprocessing.Value('i', 0, lock=False)
+            self.manager = multiprocessing.Manager()
+            self.run_contexts = self.manager.dict()
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_route_worker,
+            initargs=(self.island_graph, self.current_run, self.run_contexts),
         )
+        self.pool_workers = workers
+        return self.pool
 
-        # 避免 maximum recursion depth exceeded
-        if not route:
-            print('no route', island, self.exchanges[island].remain_exchange, swap_cost)
-            return []
-
-        route_exchanges = self.virtual_execute_exchange(route, island_trades)
-        index += 1
-
-        group = [Route_tuple(f'Group {index}', route_exchanges)]
-
-        tradable_islands = list(filter(lambda x: x[1].remain_exchange > 0, self.exchanges.items()))
-        if len(tradable_islands) <= 0:
-            return group
-
-        next_route = self.find_best_routes(index, tradable_islands[0][0], remain_swap_cost)
+    def cancel_pool_tasks(self):
+        # 執行編號歸零, pool 裡還在跑的子問題看到編號改變就會停止
+        if self.current_run is not None:
+            self.current_run.value = 0
 
-        return group + next_route
-
-    def route_dp(self, state, visited, island_trades, exchanges):
-        current_island, current_weight, current_swap_cost, current_priority = state
-
-        if current_weight > self.ship_load_capacity - 100 or current_swap_cost <= self.min_swap_cost:
-            return current_priority, visited, island_trades, current_swap_cost
-
-        if len(exchanges) == len(visited):
-            return current_priority, visited, island_trades, current_swap_cost
-
-        max_value = -float('inf')
-        best_route = set()
-        best_island_trades = {}
-        best_remain_swap_cost = 0
-        all_exchange_zero = True
-
-        for exchange in exchanges.values():
-            if exchange.island in visited:
-                continue
-
-            if not self.island_graph.is_island_valid(exchange.island, visited):
-                continue
-
-            available_stock = self.stock.count_available_stock(exchange)
-            max_allowable_trades = exchange.count_max_allowable_trades(
-                self.ship_load_capacity - current_weight,
-                available_stock,
-                current_swap_cost
-            )
-
-            if max_allowable_trades <= 0:
-                continue
-
-            if current_weight + (max_allowable_trades * exchange.ratio * exchange.weight) \
-                    > self.ship_load_capacity:
-                continue
+    def close_pool(self):
+        if self.pool is None:
+            return
+        self.cancel_pool_tasks()
+        self.pool.shutdown(cancel_futures=True)
+        self.pool = None
+        self.pool_workers = 0
+        self.manager.shutdown()
+        self.manager = None
+        self.run_contexts = None
+        self.current_run = None
 
-            all_exchange_zero = False
-            new_state = (
-                exchange.island,
-                current_weight + (max_allowable_trades * exchange.ratio * exchange.weight),
-                current_swap_cost - (max_allowable_trades * exchange.swap_cost),
-                exchange.priority + current_priority,
-            )
-            island_trades[exchange.island] = max_allowable_trades
-            value, route, route_trades, remain_swap_cost = self.route_dp(
-                new_state, visited | {exchange.island},
-                island_trades.copy(),
-                exchanges
+    def find_specify_route(self, start_island, end_island, remain_swap_cost):
+        with self.trace_span('find_specify_route', end_island=end_island):
+            target_islands = self.island_graph.find_passed_islands(start_island, end_island)
+            target_islands.extend(self.island_graph.find_nearby_islands(start_island, 7))
+            target_exchanges = {island: self.exchanges[island] for island in target_islands if
+                                self.exchanges.get(island)}
+            _, route_1, island_trades_1, remain_swap_cost = self.route_dp(
+                (self.island_graph.start_island, 0, remain_swap_cost, 0),
+                set(),
+                {},
+                target_exchanges
             )
+            return self.virtual_execute_exchange(route_1, island_trades_1), remain_swap_cost
 
-            if value > max_value:
-                max_value = value
-                best_route = route
-                best_island_trades = route_trades
-                best_remain_swap_cost = remain_swap_cost
-
-        if all_exchange_zero:
-            return current_priority, visited, island_trades, current_swap_cost
+    def find_best_routes(self, index, island, swap_cost):
+        while swap_cost >= self.min_swap_cost:
+            with self.trace_span('find_best_routes', group=index + 1, island=island):
+                pr, route, island_trades, remain_swap_cost = self.route_dp((
+                    island,
+                    0,
+                    swap_cost,
+                    self.exchanges[island].priority,
+                ),
+                    set(),
+                    {},
+                    self.exchanges
+                )
+
+                # 避免無限迴圈
+                if not route:
+                    logging.debug(f'no route {island} {self.exchanges[island].remain_exchange} {swap_cost}')
+                    return
+
+                route_exchanges = self.virtual_execute_exchange(route, island_trades)
+            index += 1
+
+            yield Route_tuple(f'Group {index}', route_exchanges)
+
+            if self.is_cancelled():
+                return
+
+            tradable_islands = list(filter(lambda x: x[1].remain_exchange > 0, self.exchanges.items()))
+            if len(tradable_islands) <= 0:
+                return
+
+            island = tradable_islands[0][0]
+            swap_cost = remain_swap_cost
 
-        return max_value, best_route, best_island_trades, best_remain_swap_cost
+    def route_dp(self, state, visited, island_trades, exchanges):
+        solver = RouteSolver(
+            self.island_graph, self.stock, exchanges,
+            self.ship_load_capacity, self.min_swap_cost,
+            self.branch_and_bound, self.deadline, self.stats, self.tracer, self.cancel_event,
+        )
+        with self.trace_span('route_dp', exchanges=len(exchanges)):
+            if self.is_parallel(exchanges):
+                result = self.solve_parallel(solver, state, visited, island_trades)
+            else:
+                result = solver.solve(state, visited, island_trades)
+        if solver.timed_out:
+            self.is_optimal = False
+        return result
+
+    def is_parallel(self, exchanges):
+        # 小的子問題在本行程算比較快, process 間傳遞的成本比搜尋本身還高
+        if self.run_workers <= 1 or self.is_cancelled():
+            return False
+        tradable = sum(1 for exchange in exchanges.values() if exchange.remain_exchange > 0)
+        return tradable >= parallel_min_exchanges
+
+    def solve_parallel(self, solver, state, visited, island_trades):
+        executor = self.get_pool(self.run_workers)
+        self.run_id += 1
+        self.current_run.value = self.run_id
+        try:
+            return solver.solve_parallel(state, visited, island_trades, executor, self.run_contexts, self.run_id)
+        finally:
+            self.cancel_pool_tasks()
+            self.run_contexts.pop(self.run_id, None)
 
     def virtual_execute_exchange(self, route, island_trades):
+        with self.trace_span('virtual_execute_exchange', stations=len(route)):
+            with self.trace_span('find_best_path', islands=len(route)):
+                best_path = self.island_graph.find_best_path(list(route))
+
         route_exchanges = []
-        for island in self.island_graph.find_best_path(list(route)):
+        for island in best_path:
             trades = island_trades[island]
             exchange = self.exchanges[island]
             self.stock.execute_exchange(exchange, trades)
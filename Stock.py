@@ -1,18 +1,124 @@
+import json
 import logging
 from collections import defaultdict
+from contextlib import contextmanager, nullcontext
 
-from exchange_items import trade_items
-from utility import Save, Exchange
+import numpy as np
+
+from exchange_items import trade_items, stock_journal_file, stock_compact_events
+from utility import Save, Exchange, EventJournal, persistence
+
+no_event = nullcontext()
+
+
+def count_item_level(trade_items):
+    item_level = {}
+    for level, items in trade_items.items():
+        for item in items:
+            item_level[item['name']] = level
+    return item_level
+
+
+def count_item_weight(trade_items):
+    item_weight = {}
+    for level, items in trade_items.items():
+        for item in items:
+            weight = 1
+            if level == 1:
+                weight = 100
+            elif level == 2:
+                weight = 800
+            elif level == 3:
+                weight = 900
+            elif level == 4 or level == 5 or level == 'material':
+                weight = 1000
+            item_weight[item['name']] = weight
+    return item_weight
+
+
+class StockLedger:
+    def __init__(self, item_ids, counts):
+        # 以物品編號對應陣列位置, 每次變動記一筆 (item_id, delta), 還原時只需倒回變動
+        self.item_ids = item_ids
+        self.base = np.array(counts, dtype=np.int64)
+        self.counts = self.base.copy()
+        self.journal = []
+
+    def __getitem__(self, item):
+        return int(self.counts[self.item_ids[item]])
+
+    def __setitem__(self, item, value):
+        item_id = self.item_ids[item]
+        self.add(item_id, value - self.counts[item_id])
+
+    def __contains__(self, item):
+        return item in self.item_ids
+
+    def __iter__(self):
+        return iter(self.item_ids)
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def get(self, item, default=None):
+        item_id = self.item_ids.get(item)
+        if item_id is None:
+            return default
+        return int(self.counts[item_id])
+
+    def keys(self):
+        return self.item_ids.keys()
+
+    def values(self):
+        return self.counts.tolist()
+
+    def items(self):
+        return zip(self.item_ids.keys(), self.counts.tolist())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def add(self, item_id, delta):
+        if not delta:
+            return
+        self.counts[item_id] += delta
+        self.journal.append((item_id, int(delta)))
+
+    def snapshot(self):
+        return len(self.journal)
+
+    def rollback(self, snapshot=0):
+        while len(self.journal) > snapshot:
+            item_id, delta = self.journal.pop()
+            self.counts[item_id] -= delta
+
+    def changes_since(self, snapshot):
+        # 把 snapshot 之後的變動依物品加總, 只看這段紀錄, 不比對整份庫存
+        changes = defaultdict(int)
+        for item_id, delta in self.journal[snapshot:]:
+            changes[item_id] += delta
+        return changes
+
+    def rebase(self, counts):
+        self.base = np.array(counts, dtype=np.int64)
+        self.counts = self.base.copy()
+        self.journal = []
 
 
 class Stock(Save):
-    def __init__(self):
+    def __init__(self, journal=True):
         super().__init__()
 
-        self.ori_stock = {}
-        self._calc_stock = {}
+        self.item_ids = {}
+        self.item_names = []
+        self.snapshot_seq = 0
+        self.journal_reserved = {}
+        self.reserved_changes = {}
+        self.ori_stock = None
+        self._calc_stock = None
+        self.restored_version = 0
 
-        if not self.__dict__.get('trade_items'):
+        if not self.load('trade_items'):
             self.trade_items = trade_items
         else:
             int_trade_items = {}
@@ -30,18 +136,22 @@ class Stock(Save):
                 int_trade_items[level] = sorted(items, key=lambda x: order_items.get(x['name'], -float('inf')))
             self.trade_items = int_trade_items
 
-        if not self.__dict__.get('_stock'):
-            self._stock = {}
+        self.journal = EventJournal(self.folder, stock_journal_file, self.storage_backend) if journal else None
+        self._stock = self.load_stock()
 
         self.item_info = {}
         self.set_stock_default()
         self.stock = self._calc_stock
+        # 事件紀錄裡的保留數量比單獨存的 reserved_quantity 新
+        self.reserved_quantity.update(self.journal_reserved)
+        self.save_snapshot()
 
         self.item_level = self.update_item_level()
         self.item_weight = self.update_item_weight()
 
         self.auto_sell = True
         self.sell_quantity = defaultdict(int)
+        self.total_sell_quantity = 0
 
     def __getitem__(self, item):
         return self.stock.get(item, 0)
@@ -52,6 +162,79 @@ class Stock(Save):
     def switch_stock(self, is_calc=False):
         self.stock = self._calc_stock if is_calc else self._stock
 
+    def load_stock(self):
+        # 最後的快照加上之後的事件, 舊版只有 _stock 的存檔當作 seq 0 的快照
+        snapshot = self.load('stock_snapshot')
+        if snapshot:
+            seq, stock = snapshot['seq'], dict(snapshot['stock'])
+            self.journal_reserved = dict(snapshot.get('reserved', {}))
+        else:
+            seq, stock = 0, dict(self.load('_stock') or {})
+
+        self.snapshot_seq = seq
+        if self.journal is None:
+            return stock
+
+        for event in self.journal.replay(seq):
+            for item, delta in event.get('deltas', {}).items():
+                stock[item] = stock.get(item, 0) + delta
+            self.journal_reserved.update(event.get('reserved', {}))
+        return stock
+
+    def save_snapshot(self):
+        # 快照交給背景寫入, 寫完後事件紀錄只留快照之後的部分
+        if self.journal is None or self.snapshot_seq == self.journal.seq:
+            return
+        self.snapshot_seq = self.journal.seq
+        text = json.dumps({'seq': self.journal.seq, 'stock': self._stock.to_dict(),
+                           'reserved': self.reserved_quantity}, ensure_ascii=False)
+        persistence.put(self.journal, self.__class__.__name__, 'stock_snapshot', text)
+
+    @contextmanager
+    def record(self, op, **info):
+        # 實際庫存的變動寫進事件紀錄, 排程模擬用的 _calc_stock 不記
+        # 變動由庫存的 (item_id, delta) 紀錄取出, 不用複製比對整份庫存
+        if self.journal is None:
+            yield
+            return
+
+        start = self._stock.snapshot()
+        try:
+            yield
+        finally:
+            self.append_event(op, self._stock.changes_since(start), **info)
+
+    def append_event(self, op, changes, **info):
+        deltas = {self.item_names[item_id]: int(delta) for item_id, delta in changes.items() if delta}
+        reserved, self.reserved_changes = self.reserved_changes, {}
+        if not deltas and not reserved:
+            return
+
+        event = {'op': op, **info, 'deltas': deltas}
+        if reserved:
+            event['reserved'] = reserved
+        try:
+            self.journal.append(event)
+        except Exception as e:
+            logging.exception(e)
+
+        if self.journal.seq - self.snapshot_seq >= stock_compact_events:
+            self.save_snapshot()
+
+    def set_reserved_quantity(self, item, quantity):
+        # 保留數量記錄新的值, 在下一筆事件一起寫入
+        if self.reserved_quantity.get(item, 0) == quantity:
+            return
+        self.reserved_quantity[item] = quantity
+        if self.journal is not None:
+            self.reserved_changes[item] = quantity
+
+    def exchange_event(self, op, exchange: Exchange, trades):
+        if self.journal is None or self.stock is not self._stock:
+            return no_event
+        return self.record(op, island=exchange.island, source=exchange.source, target=exchange.target,
+                           trades=trades)
+
     def update_item_info(self):
         for items in self.trade_items.values():
             for item in items:
@@ -66,42 +249,71 @@ class Stock(Save):
             for item in items:
                 all_items.append(item['name'])
 
-        if not self.__dict__.get('_stock'):
-            self._stock = {}
+        stock = dict(self._stock.items()) if self.load('_stock') else {}
+
+        unset_items = set(all_items) - set(stock.keys())
+        stock.update({item: 0 for item in unset_items})
 
-        unset_items = set(all_items) - set(self._stock.keys())
-        self._stock.update({item: 0 for item in unset_items})
-        self._calc_stock = self._stock.copy()
-        self.ori_stock = self._stock.copy()
+        self.item_ids = {item: i for i, item in enumerate(stock.keys())}
+        self.item_names = list(self.item_ids)
+        counts = list(stock.values())
+        self._stock = StockLedger(self.item_ids, counts)
+        self._calc_stock = StockLedger(self.item_ids, counts)
+        self.ori_stock = StockLedger(self.item_ids, counts)
+        self.restored_version = 0
 
-        if not self.__dict__.get('reserved_quantity'):
+        if not self.load('reserved_quantity'):
             self.reserved_quantity = {item: 0 for item in all_items}
             for item in self.trade_items[5]:
                 self.reserved_quantity[item['name']] = 2
 
     def execute_exchange(self, exchange: Exchange, trades, route_id=None):
-        if exchange.level != 1:
-            self.stock[exchange.source] -= trades
+        source_id = self.item_ids[exchange.source]
+        target_id = self.item_ids[exchange.target]
 
-        self.stock[exchange.target] += trades * exchange.ratio
+        with self.exchange_event('execute', exchange, trades):
+            if exchange.level != 1:
+                self.stock.add(source_id, -trades)
 
-        if exchange.level == 5 and self.auto_sell and route_id is not None:
-            reserved_count = self.reserved_quantity.get(exchange.target, 0)
-            self.sell_quantity[route_id] += self.stock[exchange.target] - reserved_count
-            self.stock[exchange.target] = reserved_count
+            self.stock.add(target_id, trades * exchange.ratio)
+
+            if exchange.level == 5 and self.auto_sell and route_id is not None:
+                sell_quantity = int(self.stock.counts[target_id]) - self.reserved_quantity.get(exchange.target, 0)
+                self.sell_quantity[route_id] += sell_quantity
+                self.total_sell_quantity += sell_quantity
+                self.stock.add(target_id, -sell_quantity)
 
     def undo_execute_exchange(self, exchange: Exchange, trades, route_id=None):
-        if exchange.level != 1:
-            self.stock[exchange.source] += trades
-        self.stock[exchange.target] -= trades * exchange.ratio
+        source_id = self.item_ids[exchange.source]
+        target_id = self.item_ids[exchange.target]
+
+        with self.exchange_event('undo', exchange, trades):
+            if exchange.level != 1:
+                self.stock.add(source_id, trades)
+            self.stock.add(target_id, -trades * exchange.ratio)
 
-        if exchange.level == 5 and self.auto_sell and route_id is not None:
-            self.stock[exchange.target] += self.sell_quantity[route_id]
-            self.sell_quantity[route_id] = 0
+            if exchange.level == 5 and self.auto_sell and route_id is not None:
+                self.stock.add(target_id, self.sell_quantity[route_id])
+                self.total_sell_quantity -= self.sell_quantity[route_id]
+                self.sell_quantity[route_id] = 0
 
     def restore(self):
-        self._stock = self.ori_stock.copy()
-        self._calc_stock = self.ori_stock.copy()
+        # 基準庫存沒變時只倒回變動紀錄, 不用整份複製
+        if self.restored_version != self.ori_stock.snapshot():
+            changes = {}
+            if self.journal is not None:
+                changed = np.flatnonzero(self._stock.counts != self.ori_stock.counts)
+                changes = {int(i): int(self.ori_stock.counts[i] - self._stock.counts[i]) for i in changed}
+            self._stock.rebase(self.ori_stock.counts)
+            self._calc_stock.rebase(self.ori_stock.counts)
+            self.restored_version = self.ori_stock.snapshot()
+        else:
+            changes = {item_id: -delta for item_id, delta in self._stock.changes_since(0).items()}
+            self._stock.rollback()
+            self._calc_stock.rollback()
+
+        if self.journal is not None:
+            self.append_event('restore', changes)
 
     def add_trade_items(self, level, item):
         self.trade_items[level].append({'name': item})
@@ -120,33 +332,16 @@ class Stock(Save):
         self.update_item_info()
 
     def update_item_level(self):
-        item_level = {}
-        for level, items in self.trade_items.items():
-            for item in items:
-                item_level[item['name']] = level
-        return item_level
+        return count_item_level(self.trade_items)
 
     def update_item_weight(self):
-        item_weight = {}
-        for level, items in self.trade_items.items():
-            for item in items:
-                weight = 1
-                if level == 1:
-                    weight = 100
-                elif level == 2:
-                    weight = 800
-                elif level == 3:
-                    weight = 900
-                elif level == 4 or level == 5 or level == 'material':
-                    weight = 1000
-                item_weight[item['name']] = weight
-        return item_weight
+        return count_item_weight(self.trade_items)
 
     def switch_auto_sell(self, auto_sell):
         self.auto_sell = auto_sell
 
     def count_income(self):
-        return sum(self.sell_quantity.values()) * 7500000
+        return self.total_sell_quantity * 7500000
 
     def count_available_stock(self, exchange: Exchange):
         if exchange.level == 'material':
@@ -156,6 +351,6 @@ class Stock(Save):
     def save(self):
         super().save(
             'trade_items',
-            '_stock',
             'reserved_quantity',
         )
+        self.save_snapshot()
@@ -33,6 +33,8 @@ class MainWindow(WidgetView):
             self.island_graph = island_graph
             self.islands = sorted(list(island_graph.island_group_map.keys()))
             self.schedule = Scheduler(self.stock, self.island_graph)
+            self.worker = None
+            self.stopping_worker = None
 
             main_layout = QHBoxLayout(self)
 
@@ -49,7 +51,11 @@ class MainWindow(WidgetView):
 
             self.submit_button = QPushButton("Submit")
             self.submit_button.clicked.connect(self.run_schedule)
-            self.submit_button_signal.connect(self.route_view.update_routes)
+            self.submit_button_signal.connect(self.route_view.finish_routes)
+
+            self.cancel_button = QPushButton("Cancel")
+            self.cancel_button.clicked.connect(self.cancel_schedule)
+            self.cancel_button.setEnabled(False)
             self.submit_button_signal.connect(self.hint_view.generate_hints)
 
             self.save_exchange_button = QPushButton("Save Exchange")
@@ -94,6 +100,7 @@ class MainWindow(WidgetView):
         action_layout.addWidget(self.save_exchange_button)
         action_layout.addWidget(self.save_remain_exchange_button)
         action_layout.addWidget(self.submit_button)
+        action_layout.addWidget(self.cancel_button)
         left_layout.addLayout(action_layout)
 
         left_layout.addWidget(self.hint_view)
@@ -144,6 +151,10 @@ class MainWindow(WidgetView):
         self.stock_view.setEnabled(is_enabled)
         self.setEnabled(is_enabled)
 
+        # 排程中仍可取消或重新送出
+        self.submit_button.setEnabled(True)
+        self.cancel_button.setEnabled(not is_enabled)
+
     def update_exchanges(self):
         exchanges = {}
         for group in self.middle_view.exchange_settings:
@@ -158,21 +169,75 @@ class MainWindow(WidgetView):
             exchanges[island] = (source, target, ratio, swap_cost, group.remain_trades)
         self.schedule.add_trade(exchanges)
 
+    def stop_worker(self):
+        # 只通知取消, 不在 GUI 執行緒等待; 被取代的 worker 不再更新畫面
+        worker = self.worker
+        self.worker = None
+        worker.cancel()
+        worker.route_found.disconnect()
+        worker.schedule_finished.disconnect()
+        worker.stats_updated.disconnect()
+        return worker
+
     def run_schedule(self):
         try:
             self.enabled_view(False)
             self.section_middle.switch_content(False)
             self.section_route_view.switch_content(True)
+            self.route_view.start_loading()
 
+            # 舊的排程還在跑時, 等它結束 (finished) 再開始新的
+            if self.stopping_worker is not None:
+                return
+            if self.worker is not None and self.worker.isRunning():
+                self.stopping_worker = self.stop_worker()
+                self.stopping_worker.finished.connect(self.start_schedule)
+                return
+            self.start_schedule()
+        except Exception as e:
+            logging.exception(e)
+
+    def start_schedule(self):
+        try:
+            self.stopping_worker = None
             self.update_exchanges()
             self.worker = Worker(self.schedule)
-            self.worker.finished.connect(self.submit_button_signal.emit)
+            self.worker.route_found.connect(self.on_route_found)
+            self.worker.schedule_finished.connect(self.on_schedule_finished)
+            self.worker.stats_updated.connect(self.on_stats_updated)
             self.worker.start()
-            self.route_view.start_loading()
         except Exception as e:
             logging.exception(e)
 
+    def cancel_schedule(self):
+        try:
+            if self.worker is not None:
+                self.worker.cancel()
+        except Exception as e:
+            logging.exception(e)
+
+    # 被取代的 worker 還在佇列裡的 signal 不處理
+    def on_route_found(self, route):
+        if self.sender() is self.worker:
+            self.route_view.add_route(route)
+
+    def on_schedule_finished(self, routes, is_optimal):
+        if self.sender() is self.worker:
+            self.route_view.update_optimal(is_optimal)
+            self.submit_button_signal.emit(routes)
+
+    def on_stats_updated(self, stats):
+        if self.sender() is self.worker:
+            self.route_view.update_stats(stats)
+
     def closeEvent(self, a0):
+        # 關閉視窗時要等排程的執行緒結束, 取消後很快就會停
+        for worker in (self.worker, self.stopping_worker):
+            if worker is not None:
+                worker.cancel()
+                worker.wait()
+        # 只把快照交給背景寫入, 程式結束前才等它寫完
         self.schedule.save_settings()
+        self.schedule.close_pool()
         self.stock.save()
         a0.accept()
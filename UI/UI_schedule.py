@@ -1,13 +1,14 @@
 import logging
+import os
 from collections import defaultdict
 
 from PyQt5 import QtCore
 from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QSpinBox, QSizePolicy, QLineEdit, QComboBox, \
-    QPushButton, QCheckBox, QSpacerItem, QGroupBox
+    QPushButton, QCheckBox, QSpacerItem, QTreeView, QHeaderView, QAbstractItemView, QDoubleSpinBox
 
 from Stock import Stock
-from UI.UI_widget import ScrollableWidget, ExchangeSetting, Station, PlotDrawer, WidgetView
+from UI.UI_widget import ScrollableWidget, ExchangeSetting, PlotDrawer, WidgetView, RouteModel, StationDelegate
 from exchange_items import default_ship_load_capacity, default_remain_swap_cost, default_amount
 from utility import read_json
 
@@ -22,6 +23,8 @@ class TopWidget(WidgetView):
         self.schedule = schedule
 
         self.load_input = None
+        self.time_budget_input = None
+        self.workers_input = None
         self.swap_cost_input = None
         self.checkbox = None
         self.add_button = None
@@ -32,6 +35,8 @@ class TopWidget(WidgetView):
 
         self.add_island_graph()
         self.add_load_layout()
+        self.add_time_budget_layout()
+        self.add_workers_layout()
         self.add_remain_swap_cost_layout()
         self.add_new_item_layout()
         self.add_auto_sell_layout()
@@ -64,6 +69,44 @@ class TopWidget(WidgetView):
 
         self.layout.addLayout(load_layout)
 
+    def add_time_budget_layout(self):
+        time_budget_layout = QHBoxLayout()
+        time_budget_label = QLabel('Time Budget (s): ')
+        self.time_budget_input = QDoubleSpinBox()
+        self.time_budget_input.setRange(0, 600)
+        self.time_budget_input.setDecimals(1)
+        # 0 表示不限時間, 一定找到最佳解
+        self.time_budget_input.setSpecialValueText('No limit')
+        self.time_budget_input.setValue(self.schedule.time_budget or 0)
+
+        self.time_budget_input.valueChanged.connect(self.on_time_budget_value_changed)
+
+        time_budget_label.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.time_budget_input.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+
+        time_budget_layout.addWidget(time_budget_label)
+        time_budget_layout.addWidget(self.time_budget_input)
+
+        self.layout.addLayout(time_budget_layout)
+
+    def add_workers_layout(self):
+        workers_layout = QHBoxLayout()
+        workers_label = QLabel('Workers: ')
+        self.workers_input = QSpinBox()
+        # 1 表示不開 process pool, 在排程的執行緒裡計算
+        self.workers_input.setRange(1, max(os.cpu_count() or 1, self.schedule.workers))
+        self.workers_input.setValue(self.schedule.workers)
+
+        self.workers_input.valueChanged.connect(self.on_workers_value_changed)
+
+        workers_label.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        self.workers_input.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+
+        workers_layout.addWidget(workers_label)
+        workers_layout.addWidget(self.workers_input)
+
+        self.layout.addLayout(workers_layout)
+
     def add_remain_swap_cost_layout(self):
         swap_cost_layout = QHBoxLayout()
         swap_cost_label = QLabel('Remain swap cost: ')
@@ -132,6 +175,7 @@ class TopWidget(WidgetView):
             pass
 
         self.stock.add_trade_items(level, self.item_input.text())
+        self.stock.save()
         self.add_item_signal.emit(self.item_input.text(), level)
         self.item_input.setText('')
 
@@ -143,6 +187,15 @@ class TopWidget(WidgetView):
 
     def on_load_value_changed(self):
         self.schedule.ship_load_capacity = self.load_input.value()
+        self.schedule.save_settings()
+
+    def on_time_budget_value_changed(self):
+        self.schedule.time_budget = self.time_budget_input.value() or None
+        self.schedule.save_settings()
+
+    def on_workers_value_changed(self):
+        self.schedule.workers = self.workers_input.value()
+        self.schedule.save_settings()
 
     def on_swap_cost_value_changed(self):
         self.schedule.total_swap_cost = self.swap_cost_input.value()
@@ -300,8 +353,6 @@ class RouteViewWidget(ScrollableWidget):
         self.stock = stock
         self.schedule = schedule
 
-        self.station_list = []
-        self.group_list = []
         self.routes = []
 
         loading_layout = QHBoxLayout()
@@ -312,48 +363,60 @@ class RouteViewWidget(ScrollableWidget):
         self.loading.hide()
         self.layout.addLayout(loading_layout)
 
+        self.optimal_label = QLabel('Best found within budget, not proven optimal')
+        self.optimal_label.setStyleSheet('color: #d1675a;')
+        self.optimal_label.hide()
+        self.layout.addWidget(self.optimal_label)
+
+        self.stats_label = QLabel('')
+        self.stats_label.setWordWrap(True)
+        self.stats_label.hide()
+        self.layout.addWidget(self.stats_label)
+
+        # 只有畫面上看得到的列才會被繪製
+        self.route_model = RouteModel(self.stock, self.schedule, self.stock_update_signal, self.income_update_signal)
+        self.route_tree = QTreeView()
+        self.route_tree.setModel(self.route_model)
+        self.route_tree.setItemDelegate(StationDelegate(parent=self.route_tree))
+        self.route_tree.setUniformRowHeights(True)
+        self.route_tree.setSelectionMode(QAbstractItemView.NoSelection)
+        self.route_tree.header().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.layout.addWidget(self.route_tree)
+
     def start_loading(self):
         self.clean_view()
+        self.optimal_label.hide()
+        self.stats_label.hide()
         self.loading.show()
 
     def stop_loading(self):
         self.loading.hide()
 
     def update_routes(self, routes):
-        self.routes = routes
+        for route in routes:
+            self.add_route(route)
+        self.finish_routes(routes)
 
-        for group_name, route in routes:
-            group = QGroupBox(group_name)
-            group_layout = QVBoxLayout(group)
-
-            self.group_list.append(group)
+    def add_route(self, route):
+        index = self.route_model.add_route(route)
+        self.route_tree.expand(index)
 
-            for exchange, trades in route:
-                station = Station(
-                    exchange,
-                    trades,
-                    self.stock,
-                    self.schedule,
-                    self.stock_update_signal,
-                    self.income_update_signal
-                )
-                group_layout.addWidget(station)
-
-                self.add_widget_to_scroll(group)
-                self.station_list.append(station)
+    def finish_routes(self, routes):
+        self.routes = routes
         self.stop_loading()
         self.route_updated_signal.emit(True)
 
+    def update_optimal(self, is_optimal):
+        self.optimal_label.setVisible(not is_optimal)
+
+    def update_stats(self, stats):
+        counters = ', '.join(f'{name}: {value:,}' for name, value in stats.get('counters', {}).items())
+        timers = ', '.join(f'{name}: {seconds:.3f}s' for name, seconds in stats.get('timers', {}).items())
+        self.stats_label.setText(f'{counters}\n{timers}')
+        self.stats_label.show()
+
     def clean_view(self):
-        for group in self.group_list:
-            if group is not None:
-                group.deleteLater()
-        self.group_list = []
-
-        for route in self.station_list:
-            if route is not None:
-                route.deleteLater()
-        self.station_list = []
+        self.route_model.clear()
 
     def add_route_by_file(self, filename):
         data = read_json(filename)
@@ -1,10 +1,8 @@
 import logging
 
-from PyQt5.QtGui import QPixmap
 from PyQt5.QtWidgets import QPushButton, QGroupBox, QGridLayout, QLabel, QSpinBox, QVBoxLayout, QHBoxLayout
 
-from UI.UI_widget import ScrollableWidget
-from utility import resource_path
+from UI.UI_widget import ScrollableWidget, get_pixmap
 
 
 class StockWidget(ScrollableWidget):
@@ -37,11 +35,8 @@ class StockWidget(ScrollableWidget):
             groupbox = QGroupBox(f"Level {level}")
             grid_layout = QGridLayout()
             for item_index, item in enumerate(item_list):
-                image_path = resource_path(f"static/{item['img']}")
-
                 label_image = QLabel()
-                pixmap = QPixmap(image_path).scaled(50, 50)
-                label_image.setPixmap(pixmap)
+                label_image.setPixmap(get_pixmap(item['img'], 50))
 
                 item_name = item['name']
                 item_count = self.stock[item['name']]
@@ -122,14 +117,16 @@ class StockWidget(ScrollableWidget):
     def confirm_count(self):
         self.stock.switch_stock(False)
         self.button_modify.setText(self.modify_count_text)
-        for item_name, (
-                quantity_label, quantity_input, reserved_label,
-                reserved_quantity_input) in self.item_spin_boxes.items():
-            self.stock[item_name] = quantity_input.value()
-            self.stock.reserved_quantity[item_name] = reserved_quantity_input.value()
-            self.item_counts[item_name].setText(f'{self.stock[item_name]}')
-            quantity_label.hide()
-            quantity_input.hide()
-            reserved_label.hide()
-            reserved_quantity_input.hide()
-            self.item_counts[item_name].show()
+        with self.stock.record('edit'):
+            for item_name, (
+                    quantity_label, quantity_input, reserved_label,
+                    reserved_quantity_input) in self.item_spin_boxes.items():
+                self.stock[item_name] = quantity_input.value()
+                self.stock.set_reserved_quantity(item_name, reserved_quantity_input.value())
+                self.item_counts[item_name].setText(f'{self.stock[item_name]}')
+                quantity_label.hide()
+                quantity_input.hide()
+                reserved_label.hide()
+                reserved_quantity_input.hide()
+                self.item_counts[item_name].show()
+        self.stock.save()
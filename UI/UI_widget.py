@@ -1,15 +1,77 @@
 import logging
+import os
 import re
+import threading
 
 from PyQt5 import QtCore
-from PyQt5.QtCore import QThread, pyqtSignal, Qt, QTimer
-from PyQt5.QtGui import QColor, QPixmap
+from PyQt5.QtCore import QThread, pyqtSignal, Qt, QTimer, QAbstractItemModel, QModelIndex, QSize
+from PyQt5.QtGui import QColor, QPixmap, QImage
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QPushButton, QFileDialog, QScrollArea, QComboBox, QHBoxLayout, \
-    QSpinBox, QLabel, QCheckBox, QToolButton, QFrame, QSizePolicy, QLineEdit
+    QSpinBox, QCheckBox, QToolButton, QFrame, QSizePolicy, QLineEdit, QStyledItemDelegate, \
+    QAbstractItemView
 
 from Scheduler import Scheduler
-from exchange_items import default_amount, level_colors
-from utility import resource_path
+from exchange_items import default_amount, level_colors, icon_atlas_image, icon_atlas_index
+from utility import resource_path, read_json
+
+
+class IconAtlas:
+    def __init__(self, image_file, index_file):
+        self.image_file = image_file
+        self.index_file = index_file
+        self.icons = {}
+        self.thread = None
+
+    def load(self):
+        # 由 build_icon_atlas.py 產生, 沒有 atlas 時退回逐張讀檔
+        try:
+            if not os.path.exists(self.image_file) or not os.path.exists(self.index_file):
+                return
+
+            image = QImage(self.image_file)
+            if image.isNull():
+                return
+
+            icons = {}
+            for size, positions in read_json(self.index_file).items():
+                size = int(size)
+                for img, (x, y) in positions.items():
+                    icons[(img, size)] = image.copy(x, y, size, size)
+            self.icons = icons
+        except Exception as e:
+            logging.exception(e)
+
+    def load_async(self):
+        # QImage 可以在背景執行緒解碼, 轉成 QPixmap 留給 UI 執行緒
+        self.thread = threading.Thread(target=self.load, daemon=True)
+        self.thread.start()
+
+    def get_image(self, img, size):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.icons.get((img, size))
+
+
+icon_atlas = IconAtlas(resource_path(icon_atlas_image), resource_path(icon_atlas_index))
+pixmap_cache = {}
+
+
+def get_pixmap(img, size):
+    # 同一張圖同一尺寸只解碼縮放一次, 所有畫面共用
+    if not img:
+        return None
+
+    key = (img, size)
+    pixmap = pixmap_cache.get(key)
+    if pixmap is None:
+        image = icon_atlas.get_image(img, size)
+        if image is not None:
+            pixmap = QPixmap.fromImage(image)
+        else:
+            pixmap = QPixmap(resource_path(f"static/{img}")).scaled(size, size)
+        pixmap_cache[key] = pixmap
+    return pixmap
 
 
 class WidgetView(QWidget):
@@ -18,7 +80,8 @@ class WidgetView(QWidget):
 
     def setEnabled(self, is_enabled):
         try:
-            for widget in self.findChildren((QPushButton, QSpinBox, QLineEdit, QComboBox, QCheckBox, QToolButton)):
+            for widget in self.findChildren(
+                    (QPushButton, QSpinBox, QLineEdit, QComboBox, QCheckBox, QToolButton, QAbstractItemView)):
                 widget.setEnabled(is_enabled)
         except Exception as e:
             logging.exception(e)
@@ -73,16 +136,29 @@ class PlotDrawer(QWidget):
 
 
 class Worker(QThread):
-    finished = pyqtSignal(list)
+    route_found = pyqtSignal(object)
+    # (routes, is_optimal), is_optimal 為 False 表示時間到或被取消, 只是目前找到的最佳結果
+    schedule_finished = pyqtSignal(list, bool)
+    stats_updated = pyqtSignal(dict)
 
     def __init__(self, schedule):
         super().__init__()
         self.schedule = schedule
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
 
     def run(self):
         try:
-            routes = self.schedule.schedule_routes()
-            self.finished.emit(routes)
+            routes = []
+            for route in self.schedule.iter_routes(
+                    self.schedule.time_budget, self.schedule.workers, self.cancel_event):
+                routes.append(route)
+                self.route_found.emit(route)
+            self.schedule_finished.emit(routes, self.schedule.is_optimal)
+            if self.schedule.stats is not None:
+                self.stats_updated.emit(self.schedule.stats.to_dict())
         except Exception as e:
             logging.exception(e)
 
@@ -281,63 +357,173 @@ class ExchangeSetting(QWidget):
 
     def on_swap_cost_changed(self):
         self.parent.schedule.default_swap_cost = self.swap_cost_input.value()
+        self.parent.schedule.save_settings()
 
 
-class Station(QWidget):
-    def __init__(self, exchange, num, stock, schedule: Scheduler, stock_update_signal, income_update_signal):
-        super().__init__()
+class RouteGroupItem:
+    __slots__ = ('name', 'stations', 'row')
 
-        self.stock = stock
-        self.schedule = schedule
-        self.exchange = exchange
-        self.trades = num
-        self.stock_update_signal = stock_update_signal
-        self.income_update_signal = income_update_signal
+    def __init__(self, name, row):
+        self.name = name
+        self.stations = []
+        self.row = row
 
-        image_path_a = resource_path(f"static/{exchange.source_img}")
-        image_path_b = resource_path(f"static/{exchange.target_img}")
 
-        pixmap_a = QPixmap(image_path_a).scaled(20, 20)
-        pixmap_b = QPixmap(image_path_b).scaled(20, 20)
+class StationItem:
+    __slots__ = ('group', 'exchange', 'trades', 'display_num', 'checked', 'row')
 
-        label_source_img = QLabel()
-        label_source_img.setPixmap(pixmap_a)
+    def __init__(self, group, exchange, trades, display_num, row):
+        self.group = group
+        self.exchange = exchange
+        self.trades = trades
+        self.display_num = display_num
+        self.checked = False
+        self.row = row
 
-        label_source_img = QLabel()
-        label_source_img.setPixmap(pixmap_b)
 
-        self.checkbox = QCheckBox()
-        self.checkbox.stateChanged.connect(self.on_checkbox_changed)
+class RouteModel(QAbstractItemModel):
+    headers = ['Island', 'Source', '', 'Target']
 
-        display_num = num
-        if exchange.level == 1:
-            display_num = num * self.stock.item_info.get(exchange.source, {}).get('amount', default_amount)
+    def __init__(self, stock, schedule: Scheduler, stock_update_signal, income_update_signal):
+        super().__init__()
 
-        layout = QHBoxLayout()
-        layout.addWidget(self.checkbox)
-        layout.addWidget(QLabel(exchange.island), 2)
-        layout.addWidget(label_source_img, 1)
-        layout.addWidget(QLabel(exchange.source), 2)
-        layout.addWidget(QLabel(f": {display_num}"), 1)
-        layout.addWidget(QLabel("   -> "), 1)
-        layout.addWidget(label_source_img, 1)
-        layout.addWidget(QLabel(exchange.target), 2)
-        self.setLayout(layout)
+        self.stock = stock
+        self.schedule = schedule
+        self.stock_update_signal = stock_update_signal
+        self.income_update_signal = income_update_signal
+        self.groups = []
+
+    def add_route(self, route):
+        group_name, stations = route
+        row = len(self.groups)
+        group = RouteGroupItem(group_name, row)
+        for i, (exchange, trades) in enumerate(stations):
+            display_num = trades
+            if exchange.level == 1:
+                display_num = trades * self.stock.item_info.get(exchange.source, {}).get('amount', default_amount)
+            group.stations.append(StationItem(group, exchange, trades, display_num, i))
+
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.groups.append(group)
+        self.endInsertRows()
+        return self.index(row, 0)
+
+    def clear(self):
+        self.beginResetModel()
+        self.groups = []
+        self.endResetModel()
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, self.groups[row])
+        return self.createIndex(row, column, parent.internalPointer().stations[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        item = index.internalPointer()
+        if isinstance(item, StationItem):
+            return self.createIndex(item.group.row, 0, item.group)
+        return QModelIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.groups)
+        item = parent.internalPointer()
+        if isinstance(item, RouteGroupItem) and parent.column() == 0:
+            return len(item.stations)
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if isinstance(index.internalPointer(), StationItem) and index.column() == 0:
+            return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable
+        return Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        item = index.internalPointer()
+        column = index.column()
+        if isinstance(item, RouteGroupItem):
+            if role == Qt.DisplayRole and column == 0:
+                return item.name
+            return None
+
+        exchange = item.exchange
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return exchange.island
+            if column == 1:
+                return f'{exchange.source}: {item.display_num}'
+            if column == 2:
+                return '->'
+            return exchange.target
+
+        if role == Qt.CheckStateRole and column == 0:
+            return Qt.Checked if item.checked else Qt.Unchecked
+
+        if role == Qt.DecorationRole:
+            if column == 1:
+                return get_pixmap(exchange.source_img, 20)
+            if column == 3:
+                return get_pixmap(exchange.target_img, 20)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or not index.isValid():
+            return False
+
+        item = index.internalPointer()
+        if not isinstance(item, StationItem):
+            return False
+
+        checked = value == Qt.Checked
+        if checked == item.checked:
+            return False
 
-    def on_checkbox_changed(self, state):
         self.stock.switch_stock(False)
 
         try:
-            if state == Qt.Unchecked:
-                self.schedule.undo_execute_exchange(self.exchange, self.trades, id(self))
+            if checked:
+                self.schedule.execute_exchange(item.exchange, item.trades, id(item))
             else:
-                self.schedule.execute_exchange(self.exchange, self.trades, id(self))
+                self.schedule.undo_execute_exchange(item.exchange, item.trades, id(item))
+            item.checked = checked
+            self.dataChanged.emit(index, index, [Qt.CheckStateRole])
 
-            self.stock_update_signal.emit([self.exchange.source, self.exchange.target])
+            self.stock_update_signal.emit([item.exchange.source, item.exchange.target])
             self.income_update_signal.emit(self.stock.count_income())
-
         except Exception as e:
             logging.exception(e)
+            return False
+        return True
+
+
+class StationDelegate(QStyledItemDelegate):
+    def __init__(self, row_height=28, parent=None):
+        super().__init__(parent)
+        self.row_height = row_height
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        option.decorationSize = QSize(20, 20)
+
+    def sizeHint(self, option, index):
+        size = super().sizeHint(option, index)
+        return QSize(size.width(), self.row_height)
 
 
 class CollapsibleSection(QWidget):
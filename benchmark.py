@@ -0,0 +1,269 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from Island import IslandGraph
+from Scheduler import Scheduler
+from Stock import Stock
+from exchange_items import island_position, trade_items, default_ship_load_capacity, default_swap_cost
+from island_trades import read_exchanges
+
+default_sizes = [5, 10, 15, 20, 25, 30, 40, 50, 60, 70]
+default_loads = [default_ship_load_capacity // 2, default_ship_load_capacity]
+stock_profiles = {
+    'low': (0, 10),
+    'medium': (5, 50),
+    'high': (50, 300),
+}
+default_import_module = 'main'
+default_import_budget = 1.0
+source_levels = {1: 'normal', 2: 1, 3: 2, 4: 3, 5: 4}
+default_ratios = {'normal': 1, 1: 3, 2: 3, 3: 2, 4: 1, 5: 1}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except Exception:
+        return ''
+
+
+def measure_import_time(module, top=10):
+    # 用 python -X importtime 在新的 process 量測, 不受目前已載入的模組影響
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True,
+    ).stderr
+
+    total = 0
+    packages = defaultdict(int)
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        packages[name.strip().split('.')[0]] += int(self_us)
+
+    return {
+        'module': module,
+        'seconds': total / 1e6,
+        'packages': {
+            name: value / 1e6
+            for name, value in sorted(packages.items(), key=lambda x: x[1], reverse=True)[:top]
+        },
+    }
+
+
+def check_import_budget(import_time, budget):
+    logging.info(f"import {import_time['module']}: {import_time['seconds']:.3f}s (budget {budget:.3f}s)")
+    if import_time['seconds'] <= budget:
+        return True
+
+    logging.error(f"import {import_time['module']} is over budget")
+    for name, seconds in import_time['packages'].items():
+        logging.error(f'    {name:<30}{seconds:.3f}s')
+    return False
+
+
+def create_exchanges(size, rnd, start_island):
+    islands = [island for island in island_position.keys() if island != start_island]
+    exchanges = {}
+    for island in rnd.sample(islands, min(size, len(islands))):
+        target_level = rnd.choice(list(source_levels.keys()))
+        source_level = source_levels[target_level]
+        source = rnd.choice(trade_items[source_level])['name']
+        target = rnd.choice(trade_items[target_level])['name']
+        exchanges[island] = (source, target, default_ratios[source_level], default_swap_cost, None)
+    return exchanges
+
+
+def set_stock(stock, profile, rnd):
+    low, high = stock_profiles[profile]
+    for item in stock.ori_stock.keys():
+        stock.ori_stock[item] = rnd.randint(low, high)
+    stock.restore()
+
+
+def wrap_timer(obj, name, timings):
+    func = getattr(obj, name)
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[name]['calls'] += 1
+            timings[name]['seconds'] += time.perf_counter() - start
+
+    setattr(obj, name, wrapper)
+
+
+def run_case(schedule, exchanges, load, total_swap_cost, repeat, time_budget):
+    schedule.ship_load_capacity = load
+    schedule.total_swap_cost = total_swap_cost
+    schedule.add_trade(exchanges)
+
+    best = None
+    for _ in range(repeat):
+        timings = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+        wrap_timer(schedule, 'route_dp', timings)
+        wrap_timer(schedule.island_graph, 'find_best_path', timings)
+        try:
+            start = time.perf_counter()
+            routes = schedule.schedule_routes(time_budget)
+            elapsed = time.perf_counter() - start
+        finally:
+            del schedule.route_dp
+            del schedule.island_graph.find_best_path
+
+        if best is None or elapsed < best['schedule_routes']:
+            best = {
+                'schedule_routes': elapsed,
+                'route_dp': dict(timings['route_dp']),
+                'find_best_path': dict(timings['find_best_path']),
+                'routes': len(routes),
+                'stations': sum(len(stations) for _, stations in routes),
+                'is_optimal': schedule.is_optimal,
+                'stats': None if schedule.stats is None else schedule.stats.to_dict(),
+            }
+    return best
+
+
+def benchmark_island_graph(start_island, repeat):
+    times = []
+    island_graph = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        island_graph = IslandGraph(start_island, draw=False)
+        times.append(time.perf_counter() - start)
+    return island_graph, min(times)
+
+
+def run(args):
+    import_time = measure_import_time(args.import_module)
+    if args.import_only:
+        return {
+            'commit': get_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'import_time': import_time,
+        }
+
+    island_graph, island_graph_seconds = benchmark_island_graph(args.start_island, args.repeat)
+    # 合成的庫存不寫進事件紀錄
+    stock = Stock(journal=False)
+    schedule = Scheduler(stock, island_graph)
+
+    cases = []
+    for size in args.sizes:
+        for load in args.loads:
+            for profile in args.stocks:
+                rnd = random.Random(f'{args.seed}_{size}_{load}_{profile}')
+                set_stock(stock, profile, rnd)
+                exchanges = create_exchanges(size, rnd, args.start_island)
+                result = run_case(schedule, exchanges, load, args.swap_cost, args.repeat, args.time_budget)
+                result.update(name=f'synthetic_{size}_{load}_{profile}', exchanges=size, load=load, stock=profile)
+                cases.append(result)
+                logging.info(f"{result['name']}: {result['schedule_routes']:.3f}s")
+
+    for filename in args.recorded:
+        exchanges, remain_swap_cost = read_exchanges(filename)
+        if not exchanges:
+            continue
+        stock.restore()
+        result = run_case(schedule, exchanges, schedule.ship_load_capacity,
+                          remain_swap_cost or args.swap_cost, args.repeat, args.time_budget)
+        result.update(name=os.path.basename(filename), exchanges=len(exchanges),
+                      load=schedule.ship_load_capacity, stock='recorded')
+        cases.append(result)
+        logging.info(f"{result['name']}: {result['schedule_routes']:.3f}s")
+
+    return {
+        'commit': get_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'time_budget': args.time_budget,
+        'island_graph': island_graph_seconds,
+        'import_time': import_time,
+        'cases': cases,
+    }
+
+
+def compare(result, baseline):
+    print(f"{'case':<40}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    if 'import_time' in baseline and 'import_time' in result:
+        base_seconds = baseline['import_time']['seconds']
+        seconds = result['import_time']['seconds']
+        print(f"{'import ' + result['import_time']['module']:<40}{base_seconds:>12.4f}{seconds:>12.4f}"
+              f"{seconds / max(base_seconds, 1e-9):>8.2f}")
+    if 'cases' not in baseline or 'cases' not in result:
+        return
+
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    print(f"{'IslandGraph':<40}{baseline['island_graph']:>12.4f}{result['island_graph']:>12.4f}"
+          f"{result['island_graph'] / max(baseline['island_graph'], 1e-9):>8.2f}")
+    for case in result['cases']:
+        base = baseline_cases.get(case['name'])
+        if not base:
+            continue
+        ratio = case['schedule_routes'] / max(base['schedule_routes'], 1e-9)
+        print(f"{case['name']:<40}{base['schedule_routes']:>12.4f}{case['schedule_routes']:>12.4f}{ratio:>8.2f}")
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes)
+    parser.add_argument('--loads', type=int, nargs='+', default=default_loads)
+    parser.add_argument('--stocks', nargs='+', choices=list(stock_profiles.keys()), default=list(stock_profiles.keys()))
+    parser.add_argument('--swap-cost', type=int, default=1000000)
+    parser.add_argument('--time-budget', type=float)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--recorded', nargs='*', default=None,
+                        help='exchange files to replay, defaults to storage/*_exchanges_*.json')
+    parser.add_argument('--start-island', default='伊利亞')
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--compare', help='previous benchmark output to compare with')
+    parser.add_argument('--import-module', default=default_import_module, help='module whose cold import is measured')
+    parser.add_argument('--import-budget', type=float, default=default_import_budget,
+                        help='seconds allowed for the cold import, exit 1 when exceeded')
+    parser.add_argument('--import-only', action='store_true', help='only measure the import time')
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = create_parser().parse_args(argv)
+    if args.recorded is None:
+        args.recorded = sorted(glob.glob('storage/*_exchanges_*.json'))
+
+    result = run(args)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(result, json.load(f))
+
+    if not check_import_budget(result['import_time'], args.import_budget):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+
+from PIL import Image
+
+from exchange_items import trade_items, icon_atlas_sizes, icon_atlas_image, icon_atlas_index
+
+
+def collect_images():
+    images = []
+    for items in trade_items.values():
+        for item in items:
+            img = item.get('img')
+            if img and img not in images:
+                images.append(img)
+    return images
+
+
+def build_atlas(folder, images, sizes, columns):
+    rows = math.ceil(len(images) / columns)
+    atlas = Image.new('RGBA', (columns * max(sizes), rows * sum(sizes)), (0, 0, 0, 0))
+
+    # 每個尺寸一個區塊, index 記錄每張圖左上角的位置
+    index = {}
+    top = 0
+    for size in sizes:
+        positions = {}
+        for i, img in enumerate(images):
+            filename = os.path.join(folder, img)
+            if not os.path.exists(filename):
+                logging.warning(f'Missing image {filename}')
+                continue
+
+            with Image.open(filename) as image:
+                icon = image.convert('RGBA').resize((size, size))
+            x = (i % columns) * size
+            y = top + (i // columns) * size
+            atlas.paste(icon, (x, y))
+            positions[img] = [x, y]
+        index[str(size)] = positions
+        top += rows * size
+    return atlas, index
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='build_icon_atlas')
+    parser.add_argument('--static', default='static', help='folder with the item images')
+    parser.add_argument('--sizes', type=int, nargs='+', default=icon_atlas_sizes)
+    parser.add_argument('--columns', type=int, default=16)
+    parser.add_argument('--image', default=icon_atlas_image)
+    parser.add_argument('--index', default=icon_atlas_index)
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = create_parser().parse_args(argv)
+
+    images = collect_images()
+    atlas, index = build_atlas(args.static, images, args.sizes, args.columns)
+    atlas.save(args.image)
+    with open(args.index, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=4)
+
+    logging.info(f'{sum(len(positions) for positions in index.values())} icons written to {args.image}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
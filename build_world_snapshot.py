@@ -0,0 +1,35 @@
+import argparse
+import logging
+import sys
+
+from Island import IslandGraph
+from exchange_items import world_snapshot_file
+from utility import write_world_snapshot
+
+
+def build_world(start_island):
+    # 不讀舊的快照也不讀寫 storage, 由來源表以固定的亂數種子重新分群
+    island_graph = IslandGraph(start_island, draw=False, snapshot=False, storage=False)
+    return island_graph.to_world_arrays()
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='build_world_snapshot')
+    parser.add_argument('--start-island', default='伊利亞')
+    parser.add_argument('--out', default=world_snapshot_file)
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    args = create_parser().parse_args(argv)
+
+    arrays = build_world(args.start_island)
+    write_world_snapshot(args.out, arrays)
+
+    logging.info(f"{len(arrays['island_groups'])} islands, {len(arrays['groups'])} groups written to {args.out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
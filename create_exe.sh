@@ -1 +1,3 @@
+python build_icon_atlas.py
+python build_world_snapshot.py
 pyinstaller --windowed -F --add-data "static/*;static/" --icon "static/icon.ico" --name "Island Trades" .\main.py
\ No newline at end of file
@@ -143,6 +143,18 @@ default_ship_load_capacity = 12991
 default_remain_swap_cost = 1000000
 default_swap_cost = 11180
 default_amount = 1
+default_time_budget = 5
+# 預設不平行; 分支定界在本行程共用目前最佳解, 拆到 process pool 常常反而更慢
+default_workers = 1
+parallel_min_exchanges = 24
+default_storage_backend = 'sqlite'
+stock_journal_file = 'stock_journal.jsonl'
+stock_compact_events = 200
+
+icon_atlas_sizes = [20, 50]
+icon_atlas_image = 'static/icon_atlas.png'
+icon_atlas_index = 'static/icon_atlas.json'
+world_snapshot_file = 'static/world_snapshot'
 
 level_colors = {
     "normal": (255, 247, 217),
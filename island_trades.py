@@ -0,0 +1,133 @@
+import argparse
+import json
+import logging
+import sys
+
+from Island import IslandGraph
+from Scheduler import Scheduler
+from Stock import Stock
+from exchange_items import default_remain_swap_cost
+from utility import read_json, get_storage, read_file_umask
+
+
+def read_exchanges(filename):
+    data = read_json(filename)
+    remain_swap_cost = data.pop('remain_swap_cost', None)
+
+    exchanges = {}
+    for island, info in data.items():
+        exchanges[island] = (
+            info['source'], info['target'], info['ratio'],
+            info['swap_cost'], info.get('remain_trades'),
+        )
+    return exchanges, remain_swap_cost
+
+
+def routes_to_json(routes):
+    return [
+        {
+            'name': name,
+            'stations': [
+                {
+                    'island': exchange.island,
+                    'source': exchange.source,
+                    'target': exchange.target,
+                    'ratio': exchange.ratio,
+                    'trades': trades,
+                }
+                for exchange, trades in stations
+            ],
+        }
+        for name, stations in routes
+    ]
+
+
+def plan(args):
+    exchanges, remain_swap_cost = read_exchanges(args.exchanges)
+    if not exchanges:
+        logging.error(f'No exchanges in {args.exchanges}')
+        return 1
+
+    island_graph = IslandGraph(args.start_island, draw=False)
+    stock = Stock()
+    schedule = Scheduler(stock, island_graph)
+
+    if args.load is not None:
+        schedule.ship_load_capacity = args.load
+
+    if args.swap_cost is not None:
+        schedule.total_swap_cost = args.swap_cost
+    elif remain_swap_cost is not None:
+        schedule.total_swap_cost = remain_swap_cost
+    else:
+        schedule.total_swap_cost = default_remain_swap_cost
+
+    time_budget = schedule.time_budget if args.time_budget is None else args.time_budget
+    workers = schedule.workers if args.workers is None else args.workers
+
+    schedule.trace = args.trace
+    schedule.add_trade(exchanges)
+    routes = schedule.schedule_routes(time_budget, workers)
+    schedule.close_pool()
+    if schedule.trace_file:
+        logging.warning(f'Trace written to {schedule.trace_file}')
+
+    result = {
+        'routes': routes_to_json(routes),
+        'is_optimal': schedule.is_optimal,
+    }
+    if schedule.stats is not None:
+        result['stats'] = schedule.stats.to_dict()
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+    else:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=4)
+        sys.stdout.write('\n')
+    return 0
+
+
+def storage(args):
+    # sqlite backend 與 json 檔互相轉換
+    sqlite_storage = get_storage(args.folder, 'sqlite')
+    if args.action == 'export':
+        objects, records = sqlite_storage.export_json()
+    else:
+        objects, records = sqlite_storage.import_json()
+    logging.warning(f'{args.action}: {objects} objects, {records} records in {args.folder}')
+    return 0
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='island_trades')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help='schedule routes for an exchanges file')
+    plan_parser.add_argument('exchanges', help='remain_exchanges_*.json or save_exchanges_*.json')
+    plan_parser.add_argument('--load', type=int, help='ship load capacity')
+    plan_parser.add_argument('--swap-cost', type=int, help='total swap cost, defaults to remain_swap_cost in the file')
+    plan_parser.add_argument('--time-budget', type=float, help='seconds to search before returning the best plan')
+    plan_parser.add_argument('--workers', type=int, help='number of worker processes')
+    plan_parser.add_argument('--start-island', default='伊利亞')
+    plan_parser.add_argument('--out', help='output file, defaults to stdout')
+    plan_parser.add_argument('--trace', action='store_true', help='write a Chrome trace of the run to storage, runs without worker processes')
+    plan_parser.set_defaults(func=plan)
+
+    storage_parser = subparsers.add_parser('storage', help='copy saved data between storage.db and json files')
+    storage_parser.add_argument('action', choices=['export', 'import'],
+                                help='export: storage.db to json files, import: json files to storage.db')
+    storage_parser.add_argument('--folder', default='storage')
+    storage_parser.set_defaults(func=storage)
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING)
+    args = create_parser().parse_args(argv)
+    read_file_umask()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import logging
+import multiprocessing
 import sys
 
 from PyQt5.QtGui import QIcon
@@ -7,13 +8,20 @@ from PyQt5.QtWidgets import QApplication
 from Island import IslandGraph
 from Stock import Stock
 from UI.UI import MainWindow
-from utility import resource_path
+from UI.UI_widget import icon_atlas
+from utility import resource_path, read_file_umask
 
 # for debug
 # logging.basicConfig(filename='app.log', level=logging.DEBUG)
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    read_file_umask()
+
+    # 圖示在背景解碼, 與建立島嶼圖同時進行
+    icon_atlas.load_async()
+
     island_graph = IslandGraph('伊利亞')
     stock = Stock()
 
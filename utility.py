@@ -1,10 +1,23 @@
+import atexit
+import hashlib
 import json
+import logging
 import math
 import os
+import re
+import sqlite3
 import sys
-from collections import namedtuple
+import tempfile
+import threading
+import time
+from collections import namedtuple, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
 
-from exchange_items import default_swap_cost
+import numpy as np
+
+from exchange_items import default_swap_cost, default_storage_backend, island_position, \
+    world_snapshot_file
 
 Station_tuple = namedtuple('Station_tuple', ['exchange', 'trades'])
 Route_tuple = namedtuple('Route_tuple', ['name', 'stations'])
@@ -15,20 +28,383 @@ def read_json(filename):
         return json.load(f)
 
 
+# mkstemp 建立的檔案權限是 0600, 新檔案改回與一般 open 相同的權限
+# 讀 umask 必須暫時改掉它, 只在程式開頭還沒有其他 thread 時由 read_file_umask 讀一次
+file_umask = 0o022
+
+
+def read_file_umask():
+    global file_umask
+    file_umask = os.umask(0)
+    os.umask(file_umask)
+
+
+@contextmanager
+def atomic_write(filename, mode='w'):
+    # 先寫到同資料夾的暫存檔再改名, 寫到一半當掉也不會弄壞原本的檔案
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', suffix='.tmp')
+    try:
+        # 覆寫既有檔案時保留它原本的權限
+        try:
+            file_mode = os.stat(filename).st_mode & 0o777
+        except FileNotFoundError:
+            file_mode = 0o666 & ~file_umask
+        os.chmod(temp_filename, file_mode)
+        with os.fdopen(fd, mode, encoding=None if 'b' in mode else 'utf-8') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+def write_text(filename, text):
+    with atomic_write(filename) as f:
+        f.write(text)
+
+
+def write_json(filename, data):
+    write_text(filename, json.dumps(data, ensure_ascii=False, indent=4))
+
+
+class JsonStorage:
+    # 每個屬性一個 {owner}_{name}.json, 紀錄存成 {kind}_{date}_v{version}.json
+    record_pattern = re.compile(r'^(?P<kind>.+)_(?P<date>\d{8})_v(?P<version>\d+)\.json$')
+    object_pattern = re.compile(r'^(?P<owner>[A-Z][A-Za-z]*)_(?P<name>.+)\.json$')
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index = None
+        self.versions = None
+        os.makedirs(self.folder, exist_ok=True)
+
+    def list_folder(self):
+        # 資料夾只列一次, 所有 Save 子類別共用; 同時記下每種紀錄每天的最新版本
+        self.index = set()
+        self.versions = {}
+        for filename in os.listdir(self.folder):
+            match = self.object_pattern.match(filename)
+            if match:
+                self.index.add((match.group('owner'), match.group('name')))
+
+            match = self.record_pattern.match(filename)
+            if match:
+                key = (match.group('kind'), match.group('date'))
+                self.versions[key] = max(self.versions.get(key, 0), int(match.group('version')))
+
+    def get_index(self):
+        if self.index is None:
+            self.list_folder()
+        return self.index
+
+    def has_object(self, owner, target_name):
+        return (owner, target_name) in self.get_index()
+
+    def read_object(self, owner, target_name):
+        if not self.has_object(owner, target_name):
+            return None
+        return read_json(os.path.join(self.folder, f'{owner}_{target_name}.json'))
+
+    def write_object(self, owner, target_name, text):
+        write_text(os.path.join(self.folder, f'{owner}_{target_name}.json'), text)
+        self.get_index().add((owner, target_name))
+
+    def latest_version(self, kind, date):
+        if self.versions is None:
+            self.list_folder()
+        return self.versions.get((kind, date), 0)
+
+    def save_record(self, kind, date, version, data):
+        filename = os.path.join(self.folder, f'{kind}_{date}_v{version}.json')
+        write_json(filename, data)
+        if self.versions is not None:
+            self.versions[(kind, date)] = max(self.versions.get((kind, date), 0), version)
+        return filename
+
+
+class SqliteStorage(JsonStorage):
+    # 屬性與紀錄存在 sqlite, 以 (owner, name) 與 (kind, date, version) 為索引
+    # 紀錄仍會匯出成 json, 讓檔案選擇視窗可以開啟
+    database = 'storage.db'
+
+    def __init__(self, folder):
+        super().__init__(folder)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(self.folder, self.database), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS objects ('
+                'owner TEXT NOT NULL, name TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (owner, name))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                'kind TEXT NOT NULL, date TEXT NOT NULL, version INTEGER NOT NULL, data TEXT NOT NULL, '
+                'PRIMARY KEY (kind, date, version))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            imported = self.connection.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone()
+
+        if not imported:
+            self.import_json()
+
+    def import_json(self):
+        # 第一次使用時匯入既有的 json 檔, 之後也可以用 island_trades storage import 手動匯入
+        objects = []
+        records = []
+        for filename in os.listdir(self.folder):
+            match = self.record_pattern.match(filename)
+            if match:
+                data = read_json(os.path.join(self.folder, filename))
+                records.append((match.group('kind'), match.group('date'), int(match.group('version')),
+                                json.dumps(data, ensure_ascii=False)))
+                continue
+
+            match = self.object_pattern.match(filename)
+            if match:
+                data = read_json(os.path.join(self.folder, filename))
+                objects.append((match.group('owner'), match.group('name'), json.dumps(data, ensure_ascii=False)))
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)', objects)
+            self.connection.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)', records)
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('json_imported', '1')")
+        self.index = None
+        return len(objects), len(records)
+
+    def export_json(self):
+        # 資料庫的內容寫回 json 檔, 用來備份或換回 json backend
+        with self.lock:
+            objects = self.connection.execute('SELECT owner, name, data FROM objects').fetchall()
+            records = self.connection.execute('SELECT kind, date, version, data FROM records').fetchall()
+        for owner, target_name, text in objects:
+            write_text(os.path.join(self.folder, f'{owner}_{target_name}.json'), text)
+        for kind, date, version, text in records:
+            JsonStorage.save_record(self, kind, date, version, json.loads(text))
+        return len(objects), len(records)
+
+    def get_index(self):
+        if self.index is None:
+            with self.lock:
+                self.index = set(self.connection.execute('SELECT owner, name FROM objects').fetchall())
+        return self.index
+
+    def read_object(self, owner, target_name):
+        if not self.has_object(owner, target_name):
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT data FROM objects WHERE owner = ? AND name = ?', (owner, target_name)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def write_object(self, owner, target_name, text):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                                    (owner, target_name, text))
+        self.get_index().add((owner, target_name))
+
+    def latest_version(self, kind, date):
+        with self.lock:
+            version, = self.connection.execute(
+                'SELECT MAX(version) FROM records WHERE kind = ? AND date = ?', (kind, date)).fetchone()
+        return version or 0
+
+    def save_record(self, kind, date, version, data):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)',
+                                    (kind, date, version, json.dumps(data, ensure_ascii=False)))
+        return super().save_record(kind, date, version, data)
+
+
+storage_backends = {
+    'json': JsonStorage,
+    'sqlite': SqliteStorage,
+}
+storages = {}
+
+
+def get_storage(folder, backend=default_storage_backend):
+    # 同一個資料夾共用一個 backend, 不存在物件上以免 pickle 到 process pool
+    key = (os.path.abspath(folder), backend)
+    storage = storages.get(key)
+    if storage is None:
+        storage = storage_backends[backend](folder)
+        storages[key] = storage
+    return storage
+
+
+class PersistenceWorker:
+    # 在背景 thread 寫檔, 同一個屬性在 delay 秒內的多次存檔只寫最後一次
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self.pending = {}
+        self.last_request = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='persistence', daemon=True)
+        self.thread.start()
+
+    def put(self, storage, owner, target_name, text):
+        with self.condition:
+            self.pending[(storage, owner, target_name)] = text
+            self.last_request = time.monotonic()
+            self.start()
+            self.condition.notify()
+
+    def take_pending(self):
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+
+            while not self.closed:
+                remain = self.last_request + self.delay - time.monotonic()
+                if remain <= 0:
+                    break
+                self.condition.wait(remain)
+
+            pending, self.pending = self.pending, {}
+            return pending
+
+    def run(self):
+        while True:
+            pending = self.take_pending()
+            for (storage, owner, target_name), text in pending.items():
+                try:
+                    storage.write_object(owner, target_name, text)
+                except Exception as e:
+                    logging.exception(e)
+
+            with self.condition:
+                if self.closed and not self.pending:
+                    return
+
+    def flush(self):
+        # 關閉程式前把還沒寫的資料寫完
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+persistence = PersistenceWorker()
+atexit.register(persistence.flush)
+
+
+class EventJournal:
+    # 只往後追加的 jsonl 事件紀錄, 每筆事件有遞增的 seq
+    # 快照記錄涵蓋到哪個 seq, 啟動時只重播之後的事件
+    def __init__(self, folder, filename, backend=default_storage_backend):
+        self.folder = folder
+        self.backend = backend
+        self.filename = os.path.join(folder, filename)
+        self.lock = threading.Lock()
+        self.events = self.read()
+        self.seq = self.events[-1]['seq'] if self.events else 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def read(self):
+        if not os.path.exists(self.filename):
+            return []
+
+        events = []
+        broken = False
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # 當掉時寫到一半的最後一行
+                    logging.warning(f'Drop broken event in {self.filename}: {line!r}')
+                    broken = True
+                    break
+
+        if broken:
+            self.write_events(events)
+        return events
+
+    def write_events(self, events):
+        write_text(self.filename, ''.join(json.dumps(event, ensure_ascii=False) + '\n' for event in events))
+
+    def replay(self, seq):
+        # seq 是快照涵蓋到的位置, 截掉事件後也不能重複使用
+        self.seq = max(self.seq, seq)
+        return [event for event in self.events if event['seq'] > seq]
+
+    def append(self, event):
+        with self.lock:
+            self.seq += 1
+            event = {'seq': self.seq, **event}
+            with open(self.filename, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(event, ensure_ascii=False) + '\n')
+            self.events.append(event)
+        return self.seq
+
+    def truncate(self, seq):
+        with self.lock:
+            self.events = [event for event in self.events if event['seq'] > seq]
+            self.write_events(self.events)
+
+    def write_object(self, owner, target_name, text):
+        # 由 persistence 在背景呼叫, 快照寫入後才截掉已涵蓋的事件
+        get_storage(self.folder, self.backend).write_object(owner, target_name, text)
+        self.truncate(json.loads(text)['seq'])
+
+
 class Save:
+    storage_backend = default_storage_backend
+
     def __init__(self):
         self.folder = 'storage'
-        os.makedirs(self.folder, exist_ok=True)
+        self.saved_state = {}
+
+    def __getattr__(self, name):
+        # 存檔的屬性第一次用到才讀取
+        if name.startswith('__') or 'saved_state' not in self.__dict__:
+            raise AttributeError(name)
+        if not self.get_storage().has_object(self.__class__.__name__, name):
+            raise AttributeError(name)
+        return self.load(name)
+
+    def get_storage(self):
+        return get_storage(self.folder, self.storage_backend)
+
+    def load(self, target_name, default=None):
+        if target_name in self.__dict__:
+            return self.__dict__[target_name]
 
-        storage_object = self.read()
-        self.__dict__.update(storage_object)
+        data = self.get_storage().read_object(self.__class__.__name__, target_name)
+        if data is None:
+            return default
 
-    def save_json(self, filename, data):
-        with open(f'{self.folder}/{filename}.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        self.__dict__[target_name] = data
+        self.saved_state[target_name] = json.dumps(data, ensure_ascii=False)
+        return data
 
-    def read_json(self, filename):
-        return read_json(f'{self.folder}/{filename}')
+    def is_dirty(self, target_name, data):
+        return self.saved_state.get(target_name) != json.dumps(data, ensure_ascii=False)
+
+    def save_object(self, target_name, data):
+        # 只寫回有變動的屬性, 在呼叫端序列化成快照, 實際寫入交給背景 thread
+        text = json.dumps(data, ensure_ascii=False)
+        if self.saved_state.get(target_name) == text:
+            return
+        self.saved_state[target_name] = text
+        persistence.put(self.get_storage(), self.__class__.__name__, target_name, text)
 
     def save(self, *args):
         for target_name in args:
@@ -36,18 +412,71 @@ class Save:
             if not target:
                 continue
 
-            self.save_json(f'{self.__class__.__name__}_{target_name}', target)
+            self.save_object(target_name, target)
 
-    def read(self):
-        prefix = f'{self.__class__.__name__}'
-        files = [f for f in os.listdir(self.folder) if f.startswith(prefix) and f.endswith('.json')]
+    def count_version(self, kind, date):
+        return self.get_storage().latest_version(kind, date)
+
+    def save_record(self, kind, data):
+        date = datetime.today().strftime('%Y%m%d')
+        version = max(self.count_version(kind, date), 1)
+        return self.get_storage().save_record(kind, date, version + 1, data)
+
+
+class SearchStats:
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start
+
+    def merge(self, counters):
+        for name, value in counters.items():
+            self.counters[name] += value
 
-        storage_object = {}
-        for filename in files:
-            data = self.read_json(filename)
-            target_name = filename.replace(f'{prefix}_', '').replace('.json', '')
-            storage_object[target_name] = data
-        return storage_object
+    def to_dict(self):
+        return {
+            'counters': dict(self.counters),
+            'timers': dict(self.timers),
+        }
+
+
+class Tracer:
+    def __init__(self, max_depth=2):
+        self.max_depth = max_depth
+        self.events = []
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self.start) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': self.pid,
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def save(self, filename):
+        # 結束時一次寫出, 避免追蹤本身影響計時
+        write_text(filename, json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, ensure_ascii=False))
 
 
 class Exchange:
@@ -116,6 +545,96 @@ class Exchange:
         )
 
 
+class ExchangeTable:
+    def __init__(self, exchanges):
+        # 交換資料依欄位存成陣列, 一次算出所有候選島的可交換次數
+        self.exchanges = list(exchanges)
+        self.ratio = np.array([exchange.ratio for exchange in exchanges], dtype=float)
+        self.weight = np.array([exchange.weight for exchange in exchanges], dtype=float)
+        self.swap_cost = np.array([exchange.swap_cost for exchange in exchanges], dtype=float)
+        self.maximum_exchange = np.array([exchange.maximum_exchange for exchange in exchanges], dtype=float)
+        self.remain_exchange = np.array([exchange.remain_exchange for exchange in exchanges], dtype=float)
+
+        # ratio 為 0 時除以 inf, 可交換次數為 0
+        self.trade_ratio = np.where(self.ratio == 0, np.inf, self.ratio)
+
+    def count_available_stock(self, stock):
+        return np.array([
+            1000 if exchange.level == 1 else stock.count_available_stock(exchange)
+            for exchange in self.exchanges
+        ], dtype=float)
+
+    def count_trade_limit(self, available_stock):
+        return np.minimum(np.minimum(self.maximum_exchange, self.remain_exchange), available_stock)
+
+    def count_max_allowable_trades(self, indices, load_capacity, trade_limit, current_swap_cost):
+        max_trades = np.floor(np.floor(load_capacity / self.weight[indices]) / self.trade_ratio[indices])
+        max_swap_cost = np.floor(current_swap_cost / self.swap_cost[indices])
+        return np.minimum(np.minimum(trade_limit[indices], max_trades), max_swap_cost).astype(int)
+
+
+def hash_content(*tables):
+    text = json.dumps(tables, ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+world_snapshot_version = 2
+world_snapshots = {}
+
+
+def world_source_hash():
+    return hash_content(world_snapshot_version, island_position)
+
+
+def world_snapshot_files(prefix):
+    # 快照是 static 底下的 {prefix}.{name}.npy 平面檔, pyinstaller 以 static/* 打包時不會被攤平
+    folder, base = os.path.split(prefix)
+    if not os.path.isdir(folder or '.'):
+        return {}
+    return {
+        filename[len(base) + 1:-len('.npy')]: os.path.join(folder, filename)
+        for filename in os.listdir(folder or '.') if filename.startswith(f'{base}.') and filename.endswith('.npy')
+    }
+
+
+def read_world_snapshot(prefix):
+    # 每個陣列一個 .npy, 以 mmap 開啟; npz 要載入 zipfile, 比直接計算還慢
+    files = world_snapshot_files(prefix)
+    if not files:
+        return None
+
+    try:
+        arrays = {name: np.load(filename, mmap_mode='r', allow_pickle=False) for name, filename in files.items()}
+    except Exception as e:
+        logging.exception(e)
+        return None
+
+    # 島嶼表改過後舊的快照就不能用
+    if 'source_hash' not in arrays or str(arrays['source_hash']) != world_source_hash():
+        logging.warning(f'{prefix} is out of date, run build_world_snapshot.py')
+        return None
+    return arrays
+
+
+def get_world_snapshot(filename=world_snapshot_file):
+    # 由 build_world_snapshot.py 產生, 不存在或失效時回傳 None, 改由來源表計算
+    if filename not in world_snapshots:
+        world_snapshots[filename] = read_world_snapshot(resource_path(filename))
+    return world_snapshots[filename]
+
+
+def write_world_snapshot(prefix, arrays):
+    # source_hash 最後寫, 寫到一半中斷的快照不會被當成有效
+    folder = os.path.dirname(prefix)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    for filename in world_snapshot_files(prefix).values():
+        os.remove(filename)
+    for name, array in dict(arrays, source_hash=np.array(world_source_hash())).items():
+        with atomic_write(f'{prefix}.{name}.npy', 'wb') as f:
+            np.save(f, array, allow_pickle=False)
+
+
 def resource_path(relative_path):
     try:
         base_path = sys._MEIPASS